@@ -0,0 +1,348 @@
+#!/usr/bin/python3
+import argparse
+import configparser
+import contextlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import rust2rpm
+
+def synthetic_manifest(features=1000, deps=200, refs=8):
+    """cargo read-manifest output for a crate with many interlinked features"""
+    dependencies = [{"name": f"dep{i}",
+                     "req": f"^0.{i % 10}",
+                     "kind": None,
+                     "optional": i % 4 != 0,
+                     "uses_default_features": i % 3 != 0,
+                     "features": [f"f{j}" for j in range(i % 5)],
+                     "target": None}
+                    for i in range(deps)]
+    feature_map = {}
+    for i in range(features):
+        f_deps = [f"feature{(i + j * 7) % features}" for j in range(1, refs // 2)]
+        f_deps += [f"dep{(i * j) % deps}/sub{j}" for j in range(refs // 2)]
+        feature_map[f"feature{i}"] = f_deps
+    feature_map["default"] = ["feature0"]
+    return {"name": "synthetic",
+            "version": "1.0.0",
+            "license": "MIT",
+            "license_file": None,
+            "readme": None,
+            "description": None,
+            "dependencies": dependencies,
+            "features": feature_map,
+            "targets": [{"name": "synthetic", "kind": ["lib"]}]}
+
+# Timings only compare on the machine they were taken on
+BASELINE = os.path.join(rust2rpm.cache.CACHEDIR, "bench-baseline.json")
+
+def _manifest(name, dependencies, features, kinds=("lib",)):
+    return {"name": name,
+            "version": "0.1.0",
+            "license": "MIT OR Apache-2.0",
+            "license_file": None,
+            "readme": "README.md",
+            "description": f"Benchmark fixture shaped like {name}",
+            "dependencies": dependencies,
+            "features": features,
+            "targets": [{"name": name.replace("-", "_"), "kind": [kind]} for kind in kinds]}
+
+def _dep(name, req, kind=None, optional=False, features=(), default=True, target=None):
+    return {"name": name, "req": req, "kind": kind, "optional": optional,
+            "uses_default_features": default, "features": list(features), "target": target}
+
+def deep_chain_manifest(depth=1000):
+    """Every feature enables the next one and one optional dependency"""
+    deps = [_dep(f"dep{i}", f"^{i % 3}.{i % 7}", optional=True) for i in range(50)]
+    features = {f"level{i}": [f"level{i + 1}", f"dep{i % 50}/level{i}"] for i in range(depth)}
+    features[f"level{depth}"] = []
+    features["default"] = ["level0"]
+    return _manifest("deep-chain", deps, features)
+
+def web_sys_like_manifest(features=1500, seed=1):
+    """Hundreds of API features depending on a few others, no optional deps"""
+    rng = random.Random(seed)
+    names = [f"Api{i}" for i in range(features)]
+    feature_map = {}
+    for i, name in enumerate(names):
+        parents = rng.sample(names[:i], min(i, rng.randint(0, 4)))
+        feature_map[name] = sorted(parents)
+    feature_map["default"] = ["std"]
+    feature_map["std"] = ["wasm-bindgen/std", "js-sys/std"]
+    deps = [_dep("js-sys", "^0.3.64", default=False),
+            _dep("wasm-bindgen", "^0.2.87", default=False),
+            _dep("wasm-bindgen-test", "^0.3.37", kind="dev"),
+            _dep("wasm-bindgen-futures", "^0.4.37", kind="dev")]
+    return _manifest("web-sys", deps, feature_map)
+
+def windows_like_manifest(fanout=5, depth=4):
+    """Namespaced features, each one enabling its parent namespace"""
+    feature_map = {"Win32": ["Foundation"], "Foundation": []}
+    level = ["Win32"]
+    for _ in range(depth):
+        children = []
+        for parent in level:
+            for i in range(fanout):
+                child = f"{parent}_Sub{i}"
+                feature_map[child] = [parent]
+                children.append(child)
+        level = children
+    feature_map["default"] = ["std"]
+    feature_map["std"] = []
+    feature_map["implement"] = ["windows-implement", "windows-interface"]
+    deps = [_dep("windows-targets", "^0.48.5"),
+            _dep("windows-implement", "^0.48.0", optional=True),
+            _dep("windows-interface", "^0.48.0", optional=True),
+            _dep("windows_x86_64_msvc", "^0.48.5", target="cfg(all(target_arch = \"x86_64\", target_env = \"msvc\"))")]
+    return _manifest("windows", deps, feature_map)
+
+def tokio_like_manifest():
+    """A handful of features fanning out to many optional dependencies"""
+    feature_map = {
+        "default": [],
+        "fs": [], "io-std": [], "io-util": ["bytes"],
+        "macros": ["tokio-macros"], "net": ["libc", "mio/os-poll", "mio/os-ext", "mio/net",
+                                            "socket2", "windows-sys/Win32_Foundation",
+                                            "windows-sys/Win32_Security",
+                                            "windows-sys/Win32_Storage_FileSystem",
+                                            "windows-sys/Win32_System_Pipes",
+                                            "windows-sys/Win32_System_SystemServices"],
+        "process": ["bytes", "libc", "mio/os-poll", "mio/os-ext", "mio/net", "signal-hook-registry",
+                    "windows-sys/Win32_Foundation", "windows-sys/Win32_System_Threading",
+                    "windows-sys/Win32_System_WindowsProgramming"],
+        "rt": [], "rt-multi-thread": ["num_cpus", "rt"],
+        "signal": ["libc", "mio/os-poll", "mio/net", "mio/os-ext", "signal-hook-registry",
+                   "windows-sys/Win32_Foundation", "windows-sys/Win32_System_Console"],
+        "sync": [], "test-util": ["rt", "sync", "time"], "time": [],
+        "stats": [], "tracing": ["dep:tracing"],
+    }
+    feature_map["full"] = sorted(f for f in feature_map if f not in ("default", "full", "stats",
+                                                                      "tracing"))
+    deps = [_dep("pin-project-lite", "^0.2.11"),
+            _dep("bytes", "^1.0.0", optional=True),
+            _dep("mio", "^0.8.9", optional=True),
+            _dep("num_cpus", "^1.8.0", optional=True),
+            _dep("parking_lot", "^0.12.0", optional=True),
+            _dep("tokio-macros", "~2.1.0", optional=True),
+            _dep("tracing", "^0.1.25", optional=True, default=False, features=["std"]),
+            _dep("socket2", "^0.5.3", optional=True, features=["all"]),
+            _dep("libc", "^0.2.145", optional=True, target="cfg(unix)"),
+            _dep("signal-hook-registry", "^1.1.1", optional=True, target="cfg(unix)"),
+            _dep("windows-sys", "^0.48", optional=True, target="cfg(windows)"),
+            _dep("autocfg", "^1.1", kind="build")]
+    deps += [_dep(name, req, kind="dev") for name, req in
+             [("tokio-test", "^0.4.0"), ("tokio-stream", "^0.1"), ("futures", "^0.3.0"),
+              ("mockall", "^0.11.1"), ("async-stream", "^0.3"), ("tempfile", "^3.1.0"),
+              ("rand", "^0.8.0"), ("proptest", "^1"), ("nix", "^0.26")]]
+    return _manifest("tokio", deps, feature_map)
+
+FIXTURES = {
+    "synthetic-wide": lambda: synthetic_manifest(2000, 300),
+    "deep-chain": deep_chain_manifest,
+    "web-sys-like": web_sys_like_manifest,
+    "windows-like": windows_like_manifest,
+    "tokio-like": tokio_like_manifest,
+}
+
+def load_fixtures():
+    # Round-trip through JSON, so they look exactly like read-manifest output
+    return {name: json.loads(json.dumps(generate())) for name, generate in sorted(FIXTURES.items())}
+
+def machine():
+    return {"node": platform.node(), "machine": platform.machine(),
+            "processor": platform.processor(), "cpus": os.cpu_count(),
+            "python": platform.python_version()}
+
+def render(md):
+    import rust2rpm.__main__ as r2r
+
+    args = argparse.Namespace(target="plain", no_auto_changelog_entry=False,
+                              minimal_buildroot=False, features=None, check_provides=None)
+    conf = configparser.ConfigParser()
+    conf.add_section(args.target)
+    template = r2r.jinja_env().get_template("main.spec")
+    # Keep the license translation notes out of the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+        kwargs = r2r.template_kwargs(args, md.name, md, packager="Bench <bench@example.com>",
+                                     conf=conf)
+        devnull.writelines(template.generate(md=md, patch_file=None, **kwargs))
+
+def _stages(manifest):
+    state = {}
+    def from_json():
+        state["md"] = rust2rpm.Metadata.from_json(manifest)
+    def resolve():
+        state["md"].feature_closures
+    def requires():
+        state["requires"] = [state["md"].requires(f) for f in state["md"].dependencies]
+    def normalize():
+        for deps in state["requires"]:
+            rust2rpm.metadata.normalize_deps(deps)
+    def render_spec():
+        render(state["md"])
+    return [("from_json", from_json), ("resolve", resolve), ("requires", requires),
+            ("normalize_deps", normalize), ("render", render_spec)]
+
+def _clear_caches():
+    rust2rpm.Dependency._normalize_req.cache_clear()
+    rust2rpm.Dependency._apply_reqs.cache_clear()
+
+def run_suite(manifest, repeat=3):
+    results = {}
+    for _ in range(repeat):
+        _clear_caches()
+        for stage, func in _stages(manifest):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = results.setdefault(stage, {"time": elapsed})
+            best["time"] = min(best["time"], elapsed)
+    # Memory separately, tracemalloc slows everything down
+    _clear_caches()
+    for stage, func in _stages(manifest):
+        tracemalloc.start()
+        func()
+        results[stage]["peak"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return results
+
+def bench_suite(args):
+    baseline = {}
+    if args.compare:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            sys.exit(f"No baseline in {args.baseline}, record one with --save-baseline")
+        if baseline.pop("machine", None) != machine():
+            sys.exit(f"{args.baseline} was recorded on a different machine")
+
+    results = {}
+    regressions = []
+    for name, manifest in load_fixtures().items():
+        results[name] = run_suite(manifest, repeat=args.repeat)
+        print(f"{name}:")
+        for stage, result in results[name].items():
+            line = f"  {stage:15} {result['time'] * 1000:9.1f} ms {result['peak'] / 1024:9.0f} KiB peak"
+            base = baseline.get(name, {}).get(stage)
+            if base is not None:
+                ratio = result["time"] / base["time"] if base["time"] else 1
+                line += f"  ({ratio:.2f}x time, {result['peak'] / max(base['peak'], 1):.2f}x memory)"
+                # Ignore noise on stages taking less than a millisecond
+                if ratio > args.tolerance and result["time"] > 0.001:
+                    regressions.append(f"{name}/{stage}")
+            print(line)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({"machine": machine(), **results}, f, indent=1, sort_keys=True)
+            f.write("\n")
+    elif regressions:
+        sys.exit(f"Slower than baseline by more than {args.tolerance}x: {', '.join(regressions)}")
+
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, current, peak
+
+def bench_memory(args):
+    manifest = synthetic_manifest(args.features, args.deps)
+    md, elapsed, current, peak = measure(rust2rpm.Metadata.from_json, manifest)
+    edges = sum(len(deps) for _, deps in md.dependencies.values())
+    print(f"from_json: {args.features} features, {args.deps} deps, {edges} feature→dep edges")
+    print(f"  time {elapsed * 1000:.1f} ms, retained {current / 1024:.0f} KiB, peak {peak / 1024:.0f} KiB")
+
+def bench_normalize(args):
+    md = rust2rpm.Metadata.from_json(synthetic_manifest(args.features, args.deps))
+    rust2rpm.Dependency._normalize_req.cache_clear()
+    rust2rpm.Dependency._apply_reqs.cache_clear()
+    start = time.perf_counter()
+    for feature in md.dependencies:
+        rust2rpm.metadata.normalize_deps(md.requires(feature))
+    elapsed = time.perf_counter() - start
+    print(f"normalize_deps over {len(md.dependencies)} features: {elapsed * 1000:.1f} ms")
+    print(f"  {rust2rpm.Dependency._normalize_req.cache_info()}")
+
+def bench_startup(args):
+    import rust2rpm.__main__ as r2r
+
+    def load(bytecode_dir):
+        r2r.jinja_env.cache_clear()
+        start = time.perf_counter()
+        env = r2r.jinja_env(bytecode_dir=bytecode_dir)
+        env.get_template("main.spec")
+        for target in ("fedora", "plain", "mageia", "opensuse"):
+            env.get_template(f"{target}-changelog.spec.inc")
+        env.get_template("opensuse-header.spec.inc")
+        return time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cold = load(tmpdir)
+        warm = min(load(tmpdir) for _ in range(5))
+    print(f"template loading: {cold * 1000:.1f} ms compiling, {warm * 1000:.1f} ms from bytecode cache")
+
+def import_time(module):
+    """Cumulative import time of module in microseconds, from python -X importtime"""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                         stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+    for line in out.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1])
+    raise ValueError(f"{module} not found in importtime output")
+
+def bench_imports(args):
+    best = min(import_time("rust2rpm.inspector") for _ in range(5))
+    print(f"import rust2rpm.inspector: {best / 1000:.1f} ms (budget {args.import_budget} ms)")
+    if best / 1000 > args.import_budget:
+        sys.exit("import time budget exceeded")
+
+BENCHMARKS = {
+    "imports": bench_imports,
+    "memory": bench_memory,
+    "normalize": bench_normalize,
+    "startup": bench_startup,
+    "suite": bench_suite,
+}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--features", type=int, default=2000)
+    parser.add_argument("--deps", type=int, default=300)
+    parser.add_argument("--import-budget", type=float, default=50,
+                        help="Maximum import time of rust2rpm.inspector in ms")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs per suite fixture, the fastest one counts")
+    parser.add_argument("--baseline", metavar="FILE", default=BASELINE,
+                        help=f"Suite baseline of this machine (default: {BASELINE})")
+    parser.add_argument("--compare", action="store_true",
+                        help="Fail the suite if a stage got slower than in --baseline")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="Slowdown against the baseline to fail the suite at")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Store suite results as the new baseline")
+    parser.add_argument("benchmark", nargs="*",
+                        help=f"Benchmarks to run: {', '.join(sorted(BENCHMARKS))} (default: all)")
+    args = parser.parse_args()
+    for name in args.benchmark:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name!r}")
+
+    for name in args.benchmark or sorted(BENCHMARKS):
+        BENCHMARKS[name](args)
+
+if __name__ == "__main__":
+    main()
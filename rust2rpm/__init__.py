@@ -1,2 +1,2 @@
 from .metadata import *
-from . import licensing
+from . import cache, cfg, index, licensing, manifest, provides, timings
@@ -1,10 +1,16 @@
 import argparse
+import collections
+import concurrent.futures
 import configparser
 import contextlib
 from datetime import datetime, timezone
 import difflib
+import functools
+import hashlib
 import itertools
+import json
 import os
+import re
 import shlex
 import shutil
 import sys
@@ -15,22 +21,21 @@ import subprocess
 
 import jinja2
 import requests
+import semantic_version as semver
 import tqdm
 
-from . import Metadata, licensing
-from .metadata import normalize_deps
+from . import Dependency, Metadata, licensing, manifest, timings
+from .cache import CACHEDIR, CrateCache, ResponseCache, locked, parse_size, sha256_file
+from .cfg import RUST_ARCHES
+from .index import CrateIndex
+from .metadata import normalize_deps, requirements
+from .provides import ProvidesIndex
 
 DEFAULT_EDITOR = "vi"
-XDG_CACHE_HOME = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
-CACHEDIR = os.path.join(XDG_CACHE_HOME, "rust2rpm")
+CARGO_REGISTRY = "/usr/share/cargo/registry"
 API_URL = "https://crates.io/api/v1/"
-JINJA_ENV = jinja2.Environment(loader=jinja2.ChoiceLoader([
-                                   jinja2.FileSystemLoader(["/"]),
-                                   jinja2.PackageLoader("rust2rpm", "templates"),
-                               ]),
-                               extensions=["jinja2.ext.do"],
-                               trim_blocks=True,
-                               lstrip_blocks=True)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+REGISTRY_ENTRY = re.compile(r"^(.+)-([0-9]+\.[0-9]+\.[0-9]+.*)$")
 
 def get_default_target():
     # TODO: add fallback for /usr/lib/os-release
@@ -87,14 +92,6 @@ def file_mtime(path):
     t = datetime.fromtimestamp(os.stat(path).st_mtime, timezone.utc)
     return t.astimezone().isoformat()
 
-@contextlib.contextmanager
-def remove_on_error(path):
-    try:
-        yield
-    except: # this is supposed to include ^C
-        os.unlink(path)
-        raise
-
 def local_toml(toml, version):
     if os.path.isdir(toml):
         toml = os.path.join(toml, "Cargo.toml")
@@ -105,43 +102,156 @@ def local_crate(crate, version):
     cratename, version = os.path.basename(crate)[:-6].rsplit("-", 1)
     return crate, cratename, version
 
+_SESSION = None
+
+def session(pool_size=None):
+    """Shared HTTP session, so connections to crates.io are reused
+
+    pool_size also resizes the connection pool of an existing session,
+    which --index creates before the number of jobs is known.
+    """
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = requests.Session()
+    if pool_size is not None:
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        _SESSION.mount("https://", adapter)
+        _SESSION.mount("http://", adapter)
+    return _SESSION
+
+RESPONSE_CACHE = ResponseCache(ttl=int(os.getenv("RUST2RPM_CACHE_TTL", 3600)))
+
+def api_json(path):
+    url = requests.compat.urljoin(API_URL, path)
+    return RESPONSE_CACHE.get_json(session(), url)
+
+_INDEX = None
+
+def use_index(location):
+    """Look versions up in a local or sparse crates.io index instead of the API"""
+    global _INDEX
+    _INDEX = CrateIndex(location, session=session()) if location else None
+    crate_versions.cache_clear()
+
+@functools.lru_cache(maxsize=None)
+def crate_versions(crate):
+    if _INDEX is not None:
+        return _INDEX.versions(crate)
+    return api_json(f"crates/{crate}/versions")["versions"]
+
+def crate_checksum(crate, version):
+    if _INDEX is not None:
+        return _INDEX.checksum(crate, version)
+    return api_json(f"crates/{crate}/{version}")["version"]["checksum"]
+
+def fetch(url, path, checksum, desc):
+    # Partial downloads are kept in <path>.part and resumed next time
+    partial = f"{path}.part"
+    try:
+        offset = os.path.getsize(partial)
+    except FileNotFoundError:
+        offset = 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    req = session().get(url, stream=True, headers=headers)
+    if offset and req.status_code == 416:
+        # Whatever is there is not a prefix of this file
+        os.unlink(partial)
+        return fetch(url, path, checksum, desc)
+    req.raise_for_status()
+    if req.status_code != 206:
+        offset = 0
+    total = req.headers.get("Content-Length")
+    total = int(total) + offset if total is not None else None
+    with open(partial, "ab" if offset else "wb") as f, \
+         tqdm.tqdm(desc=desc, total=total, initial=offset,
+                   unit="B", unit_scale=True) as progress:
+        for chunk in req.iter_content(DOWNLOAD_CHUNK_SIZE):
+            f.write(chunk)
+            progress.update(len(chunk))
+    actual = sha256_file(partial)
+    if actual != checksum:
+        os.unlink(partial)
+        raise Exception(f"Checksum mismatch for {url}: expected {checksum}, got {actual}")
+    os.replace(partial, path)
+
 def download(crate, version):
+    checksum = None
     if version is None:
         # Now we need to get latest version
-        url = requests.compat.urljoin(API_URL, f"crates/{crate}/versions")
-        req = requests.get(url)
-        req.raise_for_status()
-        versions = req.json()["versions"]
-        version = next(version["num"] for version in versions if not version["yanked"])
+        with timings.phase("resolve-version", crate=crate):
+            latest = next(version for version in crate_versions(crate) if not version["yanked"])
+        version, checksum = latest["num"], latest["checksum"]
 
     os.makedirs(CACHEDIR, exist_ok=True)
+    crate_cache = CrateCache()
     cratef_base = f"{crate}-{version}.crate"
-    cratef = os.path.join(CACHEDIR, cratef_base)
-    if not os.path.isfile(cratef):
-        url = requests.compat.urljoin(API_URL, f"crates/{crate}/{version}/download#")
-        req = requests.get(url, stream=True)
-        req.raise_for_status()
-        total = int(req.headers["Content-Length"])
-        with remove_on_error(cratef), \
-             open(cratef, "wb") as f:
-            for chunk in tqdm.tqdm(req.iter_content(), f"Downloading {cratef_base}".format(cratef_base),
-                                   total=total, unit="B", unit_scale=True):
-                f.write(chunk)
+    cratef = crate_cache.lookup(crate, version)
+    if cratef is None:
+        cratef = os.path.join(CACHEDIR, cratef_base)
+        if checksum is None:
+            checksum = crate_checksum(crate, version)
+        url = _INDEX.download_url(crate, version) if _INDEX is not None else None
+        if url is None:
+            url = requests.compat.urljoin(API_URL, f"crates/{crate}/{version}/download#")
+        # Concurrent runs wait for each other instead of writing the same file
+        with timings.phase("download", crate=crate, version=version), locked(cratef):
+            if not os.path.isfile(cratef):
+                fetch(url, cratef, checksum, f"Downloading {cratef_base}")
+                crate_cache.add(cratef, checksum)
     return cratef, crate, version
 
+def extract_manifest(archive, target_dir, prefix):
+    # Single pass over the (possibly compressed) tar stream. Only Cargo.toml
+    # is written out; *.rs files and top-level files become empty
+    # placeholders so that targets, readme and license files are still
+    # discovered, while vendored sources and test data are skipped.
+    toml_relpath = f"{prefix}/Cargo.toml"
+    for member in archive:
+        path = os.path.join(target_dir, member.name)
+        if not os.path.abspath(path).startswith(target_dir):
+            raise Exception("Unsafe filenames!")
+        if not member.isfile():
+            continue
+        relpath = member.name[len(prefix) + 1:]
+        if member.name == toml_relpath:
+            data = archive.extractfile(member).read()
+        elif member.name.startswith(f"{prefix}/") and (relpath.endswith(".rs") or "/" not in relpath):
+            data = b""
+        else:
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+def extract_all(cratef, target_dir):
+    with tarfile.open(cratef, "r") as archive:
+        for n in archive.getnames():
+            if not os.path.abspath(os.path.join(target_dir, n)).startswith(target_dir):
+                raise Exception("Unsafe filenames!")
+        archive.extractall(target_dir)
+
+def needs_cargo(toml):
+    try:
+        manifest.read_manifest(toml)
+    except manifest.UnsupportedManifest:
+        return True
+    return False
+
 @contextlib.contextmanager
 def toml_from_crate(cratef, crate, version):
     with tempfile.TemporaryDirectory() as tmpdir:
         target_dir = f"{tmpdir}/"
-        with tarfile.open(cratef, "r") as archive:
-            for n in archive.getnames():
-                if not os.path.abspath(os.path.join(target_dir, n)).startswith(target_dir):
-                    raise Exception("Unsafe filenames!")
-            archive.extractall(target_dir)
         toml_relpath = f"{crate}-{version}/Cargo.toml"
         toml = f"{tmpdir}/{toml_relpath}"
-        if not os.path.isfile(toml):
-            raise IOError("crate does not contain Cargo.toml file")
+        with timings.phase("extract", crate=crate, version=version):
+            with tarfile.open(cratef, "r|*") as archive:
+                extract_manifest(archive, target_dir, f"{crate}-{version}")
+            if not os.path.isfile(toml):
+                raise IOError("crate does not contain Cargo.toml file")
+            # cargo read-manifest, which handles what the native reader
+            # can't, checks the real files, so give it all of them
+            if needs_cargo(toml):
+                extract_all(cratef, target_dir)
         yield toml
 
 def make_patch(toml, enabled=True, tmpfile=False):
@@ -186,15 +296,19 @@ def make_diff_metadata(crate, version, patch=False, store=False):
                 raise ValueError('--store-crate can only be used for a crate')
 
             toml, crate, version = local_toml(crate, version)
-            diff = make_patch(toml, enabled=patch, tmpfile=True)
-            metadata = Metadata.from_file(toml)
+            with timings.phase("patch", file=toml):
+                diff = make_patch(toml, enabled=patch, tmpfile=True)
+            with timings.phase("read-manifest", file=toml):
+                metadata = Metadata.from_file(toml)
             return metadata.name, diff, metadata
     else:
         cratef, crate, version = download(crate, version)
 
     with toml_from_crate(cratef, crate, version) as toml:
-        diff = make_patch(toml, enabled=patch)
-        metadata = Metadata.from_file(toml)
+        with timings.phase("patch", crate=crate):
+            diff = make_patch(toml, enabled=patch)
+        with timings.phase("read-manifest", crate=crate):
+            metadata = Metadata.from_file(toml)
     if store:
         shutil.copy2(cratef, os.path.join(os.getcwd(), f"{metadata.name}-{version}.crate"))
     return crate, diff, metadata
@@ -204,49 +318,64 @@ def to_list(s):
         return []
     return list(filter(None, (l.strip() for l in s.splitlines())))
 
-def main():
-    parser = argparse.ArgumentParser("rust2rpm",
-                                     formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument("--show-license-map", action="store_true",
-                        help="Print license mappings and exit")
-    parser.add_argument("--no-auto-changelog-entry", action="store_true",
-                        help="Do not generate a changelog entry")
-    parser.add_argument("-", "--stdout", action="store_true",
-                        help="Print spec and patches into stdout")
-    parser.add_argument("-t", "--target", action="store",
-                        choices=("plain", "fedora", "mageia", "opensuse"), default=get_default_target(),
-                        help="Distribution target")
-    parser.add_argument("-p", "--patch", action="store_true",
-                        help="Do initial patching of Cargo.toml")
-    parser.add_argument("-s", "--store-crate", action="store_true",
-                        help="Store crate in current directory")
-    parser.add_argument("crate", help="crates.io name\n"
-                                      "path/to/local.crate\n"
-                                      "path/to/project/",
-                        nargs="?")
-    parser.add_argument("version", nargs="?", help="crates.io version")
-    args = parser.parse_args()
-
-    if args.show_license_map:
-        licensing.dump_sdpx_to_fedora_map(sys.stdout)
-        return
-
-    if args.crate is None:
-        parser.error('required crate/path argument missing')
-
-    crate, diff, metadata = make_diff_metadata(args.crate, args.version,
-                                               patch=args.patch,
-                                               store=args.store_crate)
-
-    JINJA_ENV.globals["normalize_deps"] = normalize_deps
-    JINJA_ENV.globals["to_list"] = to_list
-    template = JINJA_ENV.get_template("main.spec")
-
-    if args.patch and len(diff) > 0:
-        patch_file = f"{metadata.name}-fix-metadata.diff"
-    else:
-        patch_file = None
-
+@functools.lru_cache(maxsize=None)
+def jinja_env(user_templates=False, bytecode_dir=None):
+    # The root filesystem is only searched when a template path was given
+    loaders = [jinja2.PackageLoader("rust2rpm", "templates")]
+    if user_templates:
+        loaders.insert(0, jinja2.FileSystemLoader(["/"]))
+
+    # Compiled templates are kept in CACHEDIR; jinja2 invalidates them
+    # by the checksum of the template source
+    if bytecode_dir is None:
+        bytecode_dir = os.path.join(CACHEDIR, "templates")
+    try:
+        os.makedirs(bytecode_dir, exist_ok=True)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_dir)
+    except OSError:
+        bytecode_cache = None
+
+    env = jinja2.Environment(loader=jinja2.ChoiceLoader(loaders),
+                             extensions=["jinja2.ext.do"],
+                             trim_blocks=True,
+                             lstrip_blocks=True,
+                             bytecode_cache=bytecode_cache)
+    env.globals["normalize_deps"] = normalize_deps
+    env.globals["to_list"] = to_list
+    return env
+
+def feature_subpackages(metadata, distconf, provides=False, requires=False):
+    """Everything main.spec needs for the -devel subpackages, in package order"""
+    # Sorted like jinja's sort filter does, case-insensitively
+    features = sorted((f for f in metadata.dependencies if f not in (None, "default")), key=str.lower)
+
+    # Features require the Provides of the features they enable, so
+    # those strings are built once instead of once per reference
+    provided = {}
+    if provides or requires:
+        provided = {f: str(metadata.provides(f)) for f in metadata.dependencies}
+    def feature_requires(feature):
+        fdeps, deps = metadata.dependencies[feature]
+        own = [provided.get(f) or str(Dependency(metadata.name, f"={metadata._version}", features={f}))
+               for f in fdeps]
+        return sorted(own + [str(d) for d in deps], key=str.lower)
+
+    subpackages = []
+    for feature in [None, "default"] + features:
+        if feature is None:
+            pkg, conf_prefix = "   devel", "lib"
+        else:
+            pkg, conf_prefix = f"-n %{{name}}+{feature}-devel", f"lib+{feature}"
+        subpackages.append({
+            "feature": feature,
+            "pkg": pkg,
+            "provides": provided[feature] if provides else None,
+            "requires": feature_requires(feature) if requires else [],
+            "extra_requires": sorted(to_list(distconf.get(f"{conf_prefix}.requires")), key=str.lower),
+        })
+    return subpackages
+
+def template_kwargs(args, crate, metadata, packager=None, conf=None):
     kwargs = {}
     kwargs["crate"] = crate
     kwargs["target"] = args.target
@@ -293,35 +422,543 @@ def main():
         kwargs["date"] = time.strftime("%a %b %d %T %Z %Y")
     else:
         kwargs["date"] = time.strftime("%a %b %d %Y")
-    kwargs["packager"] = detect_packager()
+    kwargs["packager"] = packager if packager is not None else detect_packager()
 
     if metadata.license is not None:
-        license, comments = licensing.translate_license(args.target, metadata.license)
+        with timings.phase("license", crate=crate):
+            license, comments = licensing.translate_license(args.target, metadata.license)
         kwargs["license"] = license
         kwargs["license_comments"] = comments
 
-    conf = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
-    conf.read(".rust2rpm.conf")
-    if args.target not in conf:
-        conf.add_section(args.target)
+    if conf is None:
+        conf = read_conf(args.target)
 
     kwargs["distconf"] = conf[args.target]
 
+    if args.minimal_buildroot or args.features:
+        # Only what building with the default and the chosen features needs
+        features = ["default"] + (args.features or [])
+        unknown = [f for f in features if f not in metadata.dependencies]
+        if unknown:
+            raise ValueError(f"Unknown features: {', '.join(unknown)}")
+        closure = set().union(*(metadata.requires(f, resolve=True) for f in features))
+        buildrequires = requirements(closure, merge=True)
+        testrequires = requirements(metadata.dev_dependencies, merge=True)
+        kwargs["cargo_args"] = f" -f {','.join(args.features)}" if args.features else ""
+        # cargo resolves optional dependencies of all features against the
+        # local registry (cargo#5133), the build fails unless they are
+        # removed from Cargo.toml
+        dropped = sorted({d.name for d in metadata.all_dependencies} - {d.name for d in closure})
+        if dropped:
+            print(f"{metadata.name}: optional dependencies not BuildRequired, remove them "
+                  f"from Cargo.toml: {', '.join(dropped)}", file=sys.stderr)
+        kwargs["dropped_optional"] = dropped
+    else:
+        buildrequires = requirements(metadata.all_dependencies)
+        testrequires = requirements(metadata.dev_dependencies)
+        kwargs["cargo_args"] = ""
+        kwargs["dropped_optional"] = []
+    # Not BuildRequired either, but cargo resolves target-specific
+    # dependencies for every platform
+    kwargs["pruned"] = [f"{name} ({target})" for name, target in metadata.pruned_dependencies]
+    kwargs["buildrequires"] = sorted((Dependency._apply_reqs(*r) for r in buildrequires), key=str.lower)
+    kwargs["testrequires"] = sorted((Dependency._apply_reqs(*r) for r in testrequires), key=str.lower)
+
+    kwargs["unsatisfied"] = []
+    if args.check_provides:
+        index = provides_index(args.registry)
+        unsatisfied = sorted((Dependency._apply_reqs(*r) for r in buildrequires | testrequires
+                              if not index.satisfied(*r)), key=str.lower)
+        if unsatisfied:
+            if args.check_provides == "fail":
+                raise ValueError(f"Unsatisfied requirements: {', '.join(unsatisfied)}")
+            print(f"{metadata.name}: unsatisfied requirements: {', '.join(unsatisfied)}",
+                  file=sys.stderr)
+        kwargs["unsatisfied"] = unsatisfied
+    if is_lib:
+        kwargs["subpackages"] = feature_subpackages(metadata, kwargs["distconf"],
+                                                    provides=kwargs["include_provides"],
+                                                    requires=kwargs["include_requires"])
+    return kwargs
+
+@functools.lru_cache(maxsize=None)
+def templates_digest(template=None):
+    env = jinja_env()
+    h = hashlib.sha256()
+    for name in sorted(env.list_templates()):
+        h.update(name.encode())
+        h.update(env.loader.get_source(env, name)[0].encode())
+    if template is not None:
+        with open(template, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def sources_digest():
+    # The generator code, so that changes to it invalidate existing specs
+    # no matter how rust2rpm was installed
+    root = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(root)):
+        if name.endswith((".py", ".csv")):
+            h.update(name.encode())
+            with open(os.path.join(root, name), "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+def inputs_digest(args, cratef, packager, conf):
+    """Digest of everything a spec generated from cratef depends on"""
+    inputs = {
+        "crate": sha256_file(cratef),
+        "target": args.target,
+        "distconf": sorted(conf.items(args.target, raw=True)),
+        "templates": templates_digest(args.template and os.path.abspath(args.template)),
+        "rust2rpm": sources_digest(),
+        "packager": packager,
+        "auto_changelog_entry": not args.no_auto_changelog_entry,
+        "minimal_buildroot": args.minimal_buildroot,
+        "features": args.features,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+def digest_file(spec_file):
+    return os.path.join(os.path.dirname(spec_file), f".{os.path.basename(spec_file)}.digest")
+
+def is_up_to_date(spec_file, digest):
+    try:
+        with open(digest_file(spec_file)) as f:
+            recorded = json.load(f)
+        # A spec edited (or removed) since then is regenerated as well
+        return recorded == {"inputs": digest, "spec": sha256_file(spec_file)}
+    except (OSError, ValueError):
+        return False
+
+def generate(args, crate, version, packager=None, conf=None):
+    """Write rust-<name>.spec, return its name and the crate metadata
+
+    Crates are only looked at again when the inputs digest recorded next to
+    the spec changed, otherwise (spec_file, None) is returned.
+    """
+    digest = None
+    # Whether requirements are satisfied can change without any input changing
+    if (not args.force and not args.stdout and not args.patch and not args.store_crate
+            and not args.check_provides
+            and (not _is_path(crate) or crate.endswith(".crate"))):
+        with timings.phase("digest", crate=crate):
+            if crate.endswith(".crate"):
+                cratef, name, version = local_crate(crate, version)
+            else:
+                cratef, name, version = download(crate, version)
+            if packager is None:
+                packager = detect_packager()
+            if conf is None:
+                conf = read_conf(args.target)
+            digest = inputs_digest(args, cratef, packager, conf)
+        spec_file = f"rust-{name}.spec"
+        if is_up_to_date(spec_file, digest):
+            return spec_file, None
+
+    crate, diff, metadata = make_diff_metadata(crate, version,
+                                               patch=args.patch,
+                                               store=args.store_crate)
+    spec_file = write_spec(args, crate, metadata, diff=diff, packager=packager, conf=conf,
+                           digest=digest)
+    return spec_file, metadata
+
+def write_spec(args, crate, metadata, diff=(), packager=None, conf=None, digest=None):
+    if metadata.pruned_dependencies:
+        pruned = ", ".join(f"{name} ({target})" for name, target in metadata.pruned_dependencies)
+        print(f"{metadata.name}: dropped {len(metadata.pruned_dependencies)} dependencies "
+              f"not used on {' '.join(RUST_ARCHES)}: {pruned}", file=sys.stderr)
+
+    with timings.phase("load-template", crate=crate):
+        if args.template is not None:
+            template = jinja_env(user_templates=True).get_template(os.path.abspath(args.template))
+        else:
+            template = jinja_env().get_template("main.spec")
+
+    if args.patch and len(diff) > 0:
+        patch_file = f"{metadata.name}-fix-metadata.diff"
+    else:
+        patch_file = None
+
+    kwargs = template_kwargs(args, crate, metadata, packager=packager, conf=conf)
+
     spec_file = f"rust-{metadata.name}.spec"
-    spec_contents = template.render(md=metadata, patch_file=patch_file, **kwargs)
+    # Streamed, so specs with thousands of subpackages are never built up as one string
+    spec_contents = template.generate(md=metadata, patch_file=patch_file, **kwargs)
     if args.stdout:
         print(f"# {spec_file}")
-        print(spec_contents)
+        with timings.phase("render", crate=crate):
+            sys.stdout.writelines(spec_contents)
+        print()
         if patch_file is not None:
             print(f"# {patch_file}")
             print("".join(diff), end="")
     else:
-        with open(spec_file, "w") as fobj:
-            fobj.write(spec_contents)
+        with open(spec_file, "w") as fobj, timings.phase("render", crate=crate):
+            fobj.writelines(spec_contents)
             fobj.write("\n")
+        if digest is not None:
+            with open(digest_file(spec_file), "w") as fobj:
+                json.dump({"inputs": digest, "spec": sha256_file(spec_file)}, fobj)
         if patch_file is not None:
             with open(patch_file, "w") as fobj:
                 fobj.writelines(diff)
+    return spec_file
+
+def workspace(args, toml):
+    """Write the specs of all workspace members"""
+    with timings.phase("cargo-metadata", file=toml):
+        members = Metadata.from_workspace(toml)
+    packager = detect_packager()
+    conf = read_conf(args.target)
+    for metadata in members:
+        spec_file = write_spec(args, metadata.name, metadata, packager=packager, conf=conf)
+        print(f"{metadata.name} {metadata._version}: OK ({spec_file})", file=sys.stderr)
+    return 0
+
+def read_conf(target):
+    conf = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
+    conf.read(".rust2rpm.conf")
+    if target not in conf:
+        conf.add_section(target)
+    return conf
+
+def read_batch(f):
+    specs = []
+    for line in f:
+        line = line.split("#", 1)[0].split()
+        if not line:
+            continue
+        if len(line) > 2:
+            raise ValueError(f"Expected '<crate> [<version>]', got {' '.join(line)!r}")
+        crate, version = line if len(line) == 2 else (line[0], None)
+        specs.append((crate, version))
+    return specs
+
+def batch_name(crate, version):
+    """Name of the crate a batch entry generates the spec of"""
+    if not _is_path(crate):
+        return crate
+    if crate.endswith(".crate"):
+        return local_crate(crate, version)[1]
+    try:
+        return Metadata.from_file(local_toml(crate, version)[0]).name
+    except Exception:
+        # Reported when the entry is generated
+        return crate
+
+def batch(args):
+    if args.batch == "-":
+        specs = read_batch(sys.stdin)
+    else:
+        with open(args.batch) as f:
+            specs = read_batch(f)
+
+    # Everything that does not depend on the crate is looked up once
+    packager = detect_packager()
+    conf = read_conf(args.target)
+    session(pool_size=args.jobs)
+
+    def work(spec):
+        return generate(args, *spec, packager=packager, conf=conf)
+
+    # Only one rust-<name>.spec can be written per directory
+    scheduled = {}
+    for crate, version in specs:
+        scheduled.setdefault(batch_name(crate, version), (crate, version))
+
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+        futures = {spec: executor.submit(work, spec) for spec in scheduled.values()}
+        for crate, version in specs:
+            name = crate if version is None else f"{crate} {version}"
+            future = futures.pop((crate, version), None)
+            if future is None:
+                first = scheduled[batch_name(crate, version)]
+                first = first[0] if first[1] is None else " ".join(first)
+                print(f"{name}: SKIPPED (generating {first})", file=sys.stderr)
+                continue
+            try:
+                spec_file, metadata = future.result()
+                status = "OK" if metadata is not None else "UNCHANGED"
+                print(f"{name}: {status} ({spec_file})", file=sys.stderr)
+            except Exception as e:
+                failed += 1
+                print(f"{name}: FAILED ({e})", file=sys.stderr)
+    print(f"{len(scheduled) - failed} succeeded, {failed} failed", file=sys.stderr)
+    return 1 if failed else 0
+
+def local_registry_versions(registry):
+    versions = collections.defaultdict(list)
+    if os.path.isdir(registry):
+        for entry in os.listdir(registry):
+            m = REGISTRY_ENTRY.match(entry)
+            if m is not None:
+                versions[m.group(1)].append(m.group(2))
+    return versions
+
+def resolve_version(dep):
+    """Newest non-yanked version on crates.io satisfying dep"""
+    allow_prerelease = "-" in (dep.req or "")
+    candidates = [v["num"] for v in crate_versions(dep.name)
+                  if not v["yanked"] and (allow_prerelease or "-" not in v["num"])]
+    candidates = [v for v in candidates if dep.matches(v)]
+    if not candidates:
+        raise ValueError(f"No version of {dep.name} matches {dep.req!r}")
+    return max(candidates, key=semver.Version)
+
+def recursive(args):
+    provided = local_registry_versions(args.registry)
+
+    def visit(crate, version):
+        spec_file, metadata = generate(args, crate, version, packager=packager, conf=conf)
+        status = "OK"
+        if metadata is None:
+            # The spec is up to date, but its dependencies still have to be checked
+            status = "UNCHANGED"
+            _, _, metadata = make_diff_metadata(crate, version)
+        deps = metadata.all_dependencies
+        if args.with_dev:
+            deps |= metadata.dev_dependencies
+        missing = set()
+        unresolved = set()
+        for dep in {Dependency(dep.name, dep.req) for dep in deps}:
+            if any(dep.matches(v) for v in provided.get(dep.name, ())):
+                continue
+            try:
+                missing.add((dep.name, resolve_version(dep)))
+            except Exception as e:
+                # Reported on its own, the other dependencies are still walked
+                unresolved.add((dep.name, str(e)))
+        return spec_file, metadata, missing, unresolved, status
+
+    packager = detect_packager()
+    conf = read_conf(args.target)
+    session(pool_size=args.jobs)
+
+    # Only one rust-<name>.spec can be written per directory
+    scheduled = {}
+    skipped = set()
+    failed_deps = set()
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+        pending = {executor.submit(visit, args.crate, args.version): (args.crate, args.version)}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                crate, version = pending.pop(future)
+                try:
+                    spec_file, metadata, missing, unresolved, status = future.result()
+                except Exception as e:
+                    results.append((crate, version, f"FAILED ({e})"))
+                    continue
+                scheduled.setdefault(metadata.name, metadata._version)
+                results.append((metadata.name, metadata._version, f"{status} ({spec_file})"))
+                for name, error in sorted(unresolved - failed_deps):
+                    failed_deps.add((name, error))
+                    results.append((name, None, f"FAILED ({error})"))
+                for name, version in sorted(missing):
+                    if scheduled.get(name, version) != version:
+                        if (name, version) not in skipped:
+                            skipped.add((name, version))
+                            results.append((name, version, f"SKIPPED (generating {scheduled[name]})"))
+                        continue
+                    if name not in scheduled:
+                        scheduled[name] = version
+                        pending[executor.submit(visit, name, version)] = (name, version)
+
+    failed = 0
+    for crate, version, status in results:
+        failed += status.startswith("FAILED")
+        name = crate if version is None else f"{crate} {version}"
+        print(f"{name}: {status}", file=sys.stderr)
+    print(f"{len(results) - failed} crates processed, {failed} failed", file=sys.stderr)
+    return 1 if failed else 0
+
+@functools.lru_cache(maxsize=None)
+def provides_index(registry):
+    index = ProvidesIndex()
+    if not index.sources:
+        index.add_registry(registry)
+    if index.update():
+        with contextlib.suppress(OSError):
+            index.save()
+    return index
+
+def provides_main(argv=None):
+    parser = argparse.ArgumentParser("rust2rpm-provides",
+                                     description="Manage the index of locally available crates "
+                                                 "used by --check-provides")
+    parser.add_argument("--registry", action="append", default=[],
+                        help="Add a cargo registry directory to the index")
+    parser.add_argument("--list", action="append", default=[], metavar="FILE",
+                        help="Add a file with 'crate(...) = version' lines to the index,\n"
+                             "e.g. from dnf repoquery --provides")
+    parser.add_argument("action", choices=("update", "stats"))
+    args = parser.parse_args(argv)
+
+    index = ProvidesIndex()
+    for path in args.registry:
+        index.add_registry(path)
+    for path in args.list:
+        index.add_list(path)
+    if args.action == "update":
+        print(f"{index.update()} entries read", file=sys.stderr)
+        index.save()
+    elif args.action == "stats":
+        for path, source in sorted(index.sources.items()):
+            count = (sum(len(e["provides"]) for e in source["entries"].values())
+                     if source["type"] == "registry" else len(source["provides"]))
+            print(f"{path} ({source['type']}): {count} provides")
+    return 0
+
+def cached_crate_checksum(name):
+    """Index/API checksum of a cached <crate>-<version>.crate, None if unknown"""
+    m = REGISTRY_ENTRY.match(name[:-len(".crate")])
+    if m is None:
+        return None
+    try:
+        return crate_checksum(*m.groups())
+    except Exception as e:
+        print(f"Can't look up the checksum of {name}: {e}", file=sys.stderr)
+        return None
+
+def cache_main(argv=None):
+    parser = argparse.ArgumentParser("rust2rpm-cache",
+                                     description=f"Manage the crate cache in {CACHEDIR}")
+    parser.add_argument("--max-size", type=parse_size,
+                        help="Size limit (default: $RUST2RPM_CACHE_SIZE or 5G)")
+    parser.add_argument("--index", default=os.getenv("RUST2RPM_INDEX"),
+                        help="crates.io index to check crates without a recorded\n"
+                             "checksum against in 'verify' (default: $RUST2RPM_INDEX)")
+    parser.add_argument("action", choices=("stats", "prune", "verify"))
+    args = parser.parse_args(argv)
+    use_index(args.index)
+
+    crate_cache = CrateCache(max_size=args.max_size)
+    if args.action == "stats":
+        for key, value in crate_cache.stats().items():
+            print(f"{key}: {value}")
+    elif args.action == "prune":
+        for name in crate_cache.prune():
+            print(f"Removed {name}")
+    elif args.action == "verify":
+        bad = crate_cache.verify(cached_crate_checksum)
+        for name in bad:
+            print(f"Removed corrupted {name}")
+        return 1 if bad else 0
+    return 0
+
+def run(parser, args):
+    use_index(args.index)
+    RESPONSE_CACHE.ttl = args.cache_ttl
+
+    if args.batch is not None:
+        if args.recursive:
+            parser.error("--batch and --recursive can't be combined")
+        if args.crate is not None:
+            parser.error("crate/path arguments can't be combined with --batch")
+        if args.patch or args.stdout:
+            parser.error("--patch and --stdout can't be used with --batch")
+        sys.exit(batch(args))
+
+    if args.crate is None:
+        parser.error('required crate/path argument missing')
+
+    if _is_path(args.crate) and not args.crate.endswith(".crate"):
+        toml, _, _ = local_toml(args.crate, args.version)
+        if manifest.is_virtual_manifest(toml) or (args.workspace and manifest.is_workspace_root(toml)):
+            if args.patch or args.store_crate or args.recursive:
+                parser.error("--patch, --store-crate and --recursive can't be used with a workspace")
+            sys.exit(workspace(args, toml))
+
+    if args.recursive:
+        if args.patch or args.stdout:
+            parser.error("--patch and --stdout can't be used with --recursive")
+        sys.exit(recursive(args))
+
+    spec_file, metadata = generate(args, args.crate, args.version)
+    if metadata is None:
+        print(f"{spec_file} is up to date, use --force to regenerate it", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser("rust2rpm",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--show-license-map", action="store_true",
+                        help="Print license mappings and exit")
+    parser.add_argument("--no-auto-changelog-entry", action="store_true",
+                        help="Do not generate a changelog entry")
+    parser.add_argument("-", "--stdout", action="store_true",
+                        help="Print spec and patches into stdout")
+    parser.add_argument("-t", "--target", action="store",
+                        choices=("plain", "fedora", "mageia", "opensuse"), default=get_default_target(),
+                        help="Distribution target")
+    parser.add_argument("-p", "--patch", action="store_true",
+                        help="Do initial patching of Cargo.toml")
+    parser.add_argument("-s", "--store-crate", action="store_true",
+                        help="Store crate in current directory")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Regenerate specs even if none of their inputs changed")
+    parser.add_argument("--minimal-buildroot", action="store_true",
+                        help="Only BuildRequire what the default features need,\n"
+                             "with overlapping version ranges merged")
+    parser.add_argument("--features", type=lambda s: [f for f in s.split(",") if f],
+                        help="Comma separated features to build with in addition\n"
+                             "to the default ones (implies --minimal-buildroot)")
+    parser.add_argument("--check-provides", choices=("annotate", "fail"),
+                        help="Look requirements up in the index maintained by\n"
+                             "'rust2rpm-provides' (default: --registry) and mark\n"
+                             "unsatisfied ones in the spec or fail")
+    parser.add_argument("--template", metavar="FILE",
+                        help="Spec template to use instead of the built-in one")
+    parser.add_argument("-b", "--batch", metavar="FILE",
+                        help="Generate specs for all '<crate> [<version>]' lines\n"
+                             "in FILE ('-' for stdin)")
+    parser.add_argument("-r", "--recursive", action="store_true",
+                        help="Also generate specs for all dependencies\n"
+                             "which are not available in --registry")
+    parser.add_argument("--workspace", action="store_true",
+                        help="Generate specs for all members of a workspace root\n"
+                             "which is a package itself (virtual manifests\n"
+                             "always get specs for all members)")
+    parser.add_argument("--with-dev", action="store_true",
+                        help="Include dev-dependencies in --recursive mode")
+    parser.add_argument("--registry", default=CARGO_REGISTRY,
+                        help=f"Local cargo registry (default: {CARGO_REGISTRY})")
+    parser.add_argument("--index", default=os.getenv("RUST2RPM_INDEX"),
+                        help="crates.io index (directory or sparse index URL)\n"
+                             "to look versions up in instead of the API\n"
+                             "(default: $RUST2RPM_INDEX)")
+    parser.add_argument("--cache-ttl", type=int, default=RESPONSE_CACHE.ttl,
+                        help="Seconds to use cached crates.io API responses\n"
+                             "without revalidating them (default: $RUST2RPM_CACHE_TTL or 3600)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="Number of crates to process in parallel\n"
+                             "in --batch and --recursive modes")
+    parser.add_argument("--timings", metavar="FILE",
+                        default=os.getenv("RUST2RPM_TIMINGS"),
+                        help="Write wall/CPU time of each phase as JSON lines\n"
+                             "to FILE, '-' for stderr (default: $RUST2RPM_TIMINGS)")
+    parser.add_argument("--profile", metavar="FILE", default=os.getenv("RUST2RPM_PROFILE"),
+                        help="Dump cProfile stats to FILE, {pid} is replaced\n"
+                             "with the process id (default: $RUST2RPM_PROFILE)")
+    parser.add_argument("crate", help="crates.io name\n"
+                                      "path/to/local.crate\n"
+                                      "path/to/project/\n"
+                                      "path/to/workspace/ (all members of virtual manifests)",
+                        nargs="?")
+    parser.add_argument("version", nargs="?", help="crates.io version")
+    args = parser.parse_args()
+
+    if args.show_license_map:
+        licensing.dump_sdpx_to_fedora_map(sys.stdout)
+        return
+
+    timings.configure(args.timings, "rust2rpm")
+    with timings.profiled(args.profile), timings.phase("main"):
+        run(parser, args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,371 @@
+__all__ = ["CACHEDIR", "CrateCache", "ManifestCache", "ResponseCache"]
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import time
+
+XDG_CACHE_HOME = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+CACHEDIR = os.path.join(XDG_CACHE_HOME, "rust2rpm")
+
+_SIZE_SUFFIXES = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+# Targets are inferred from the presence of files next to the manifest,
+# so adding or removing them has to invalidate the entry as well.
+_LAYOUT_DIRS = ("", "src", os.path.join("src", "bin"))
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def atomic_write(path, data, mode="w", perms=None):
+    """Replace path with data; the file is private unless perms are given"""
+    import tempfile
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".", suffix=".tmp")
+    try:
+        if perms is not None:
+            os.fchmod(fd, perms)
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def parse_size(size):
+    """Parse sizes like 500M or 5G into bytes"""
+    size = size.strip().upper().rstrip("B").rstrip("I")
+    suffix = size[-1:] if size[-1:] in _SIZE_SUFFIXES else ""
+    return int(float(size[:len(size) - len(suffix)]) * _SIZE_SUFFIXES[suffix])
+
+@contextlib.contextmanager
+def locked(path):
+    """Hold an exclusive lock on <path>.lock"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.lock", "a") as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+
+def _reader_version():
+    # Any change to the manifest reader makes older entries unreachable
+    from . import manifest
+    return sha256_file(manifest.__file__)[:16]
+
+class ManifestCache:
+    """Parsed manifests, keyed by path and the version of the reader
+
+    Entries not used for max_age seconds are removed, at most once a day,
+    so the paths of old rpmbuild BUILDROOTs don't pile up.
+    """
+    def __init__(self, cachedir=None, max_age=30 * 24 * 3600):
+        if cachedir is None:
+            cachedir = os.path.join(CACHEDIR, "manifests")
+        self.cachedir = cachedir
+        self.max_age = max_age
+        self.version = _reader_version()
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, path):
+        key = hashlib.sha256(f"{self.version}\0{path}".encode("utf-8", "surrogateescape"))
+        return os.path.join(self.cachedir, f"{key.hexdigest()}.json")
+
+    @staticmethod
+    def _layout(path):
+        root = os.path.dirname(path)
+        layout = []
+        for d in _LAYOUT_DIRS:
+            try:
+                layout.append(os.stat(os.path.join(root, d)).st_mtime_ns)
+            except OSError:
+                layout.append(None)
+        return layout
+
+    def _load_entry(self, entry_path):
+        try:
+            with open(entry_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _store_entry(self, entry_path, entry):
+        try:
+            atomic_write(entry_path, json.dumps(entry))
+            self.prune()
+        except OSError:
+            # The cache is an optimization, read-only homes are fine
+            pass
+
+    def _touch(self, entry_path):
+        with contextlib.suppress(OSError):
+            os.utime(entry_path)
+
+    def prune(self, force=False):
+        """Remove entries unused for max_age seconds, return how many"""
+        stamp = os.path.join(self.cachedir, ".pruned")
+        now = time.time()
+        try:
+            if not force and now - os.stat(stamp).st_mtime < 24 * 3600:
+                return 0
+        except FileNotFoundError:
+            pass
+        with open(stamp, "w"):
+            pass
+        removed = 0
+        for entry in os.scandir(self.cachedir):
+            if not entry.name.endswith(".json"):
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                if now - entry.stat().st_mtime > self.max_age:
+                    os.unlink(entry.path)
+                    removed += 1
+        return removed
+
+    def get(self, path, loader):
+        """Return the manifest for path, calling loader(path) on a miss"""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        layout = self._layout(path)
+        entry_path = self._entry_path(path)
+        entry = self._load_entry(entry_path)
+
+        if entry is not None and entry["layout"] == layout:
+            if entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns:
+                self.hits += 1
+                self._touch(entry_path)
+                return entry["manifest"]
+            digest = sha256_file(path)
+            if entry["sha256"] == digest:
+                # Touched, but not modified
+                self.hits += 1
+                entry["size"], entry["mtime"] = st.st_size, st.st_mtime_ns
+                self._store_entry(entry_path, entry)
+                return entry["manifest"]
+        else:
+            digest = sha256_file(path)
+
+        self.misses += 1
+        manifest = loader(path)
+        self._store_entry(entry_path, {"version": self.version,
+                                       "path": path,
+                                       "size": st.st_size,
+                                       "mtime": st.st_mtime_ns,
+                                       "sha256": digest,
+                                       "layout": layout,
+                                       "manifest": manifest})
+        return manifest
+
+class ResponseCache:
+    """Disk cache for JSON API responses, revalidated with ETag/Last-Modified
+
+    Entries younger than ttl seconds are used without asking the server.
+    When the server can't be reached, stale entries are used anyway.
+    """
+    def __init__(self, cachedir=None, ttl=3600):
+        if cachedir is None:
+            cachedir = os.path.join(CACHEDIR, "http")
+        self.cachedir = cachedir
+        self.ttl = ttl
+
+    def _entry_path(self, url):
+        return os.path.join(self.cachedir, f"{hashlib.sha256(url.encode()).hexdigest()}.json")
+
+    def get_json(self, session, url):
+        import requests
+
+        entry_path = self._entry_path(url)
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+
+        if entry is not None and time.time() - entry["fetched"] < self.ttl:
+            return entry["body"]
+
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            req = session.get(url, headers=headers)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if entry is None:
+                raise
+            print(f"Using cached {url} ({e})", file=sys.stderr)
+            return entry["body"]
+
+        if req.status_code == 304 and entry is not None:
+            entry["fetched"] = time.time()
+        else:
+            req.raise_for_status()
+            entry = {"url": url,
+                     "etag": req.headers.get("ETag"),
+                     "last_modified": req.headers.get("Last-Modified"),
+                     "fetched": time.time(),
+                     "body": req.json()}
+        try:
+            atomic_write(entry_path, json.dumps(entry))
+        except OSError:
+            pass
+        return entry["body"]
+
+class CrateCache:
+    """Index of the downloaded .crate files with LRU eviction
+
+    CACHEDIR/crates.json records size, checksum and last use of every
+    crate; it is only modified while holding its lock. Resumable
+    <crate>.part downloads count towards the size limit as well, and
+    <crate>.lock files are removed together with their crate.
+    """
+    def __init__(self, cachedir=None, max_size=None):
+        if cachedir is None:
+            cachedir = CACHEDIR
+        if max_size is None:
+            max_size = parse_size(os.getenv("RUST2RPM_CACHE_SIZE", "5G"))
+        self.cachedir = cachedir
+        self.index_path = os.path.join(cachedir, "crates.json")
+        self.max_size = max_size
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _sync(self, entries):
+        # Adopt crates downloaded by older versions, forget removed ones
+        present = {f for f in os.listdir(self.cachedir) if f.endswith(".crate")}
+        for name in set(entries) - present:
+            del entries[name]
+        for name in present - set(entries):
+            st = os.stat(os.path.join(self.cachedir, name))
+            entries[name] = {"size": st.st_size, "sha256": None, "atime": st.st_mtime}
+
+    def _partial(self):
+        """Size and mtime of every <crate>.part, by crate file name"""
+        partial = {}
+        for entry in os.scandir(self.cachedir):
+            if entry.name.endswith(".crate.part"):
+                with contextlib.suppress(FileNotFoundError):
+                    st = entry.stat()
+                    partial[entry.name[:-len(".part")]] = (st.st_size, st.st_mtime)
+        return partial
+
+    def _remove_leftovers(self, name):
+        """Remove <name>.part and <name>.lock unless a download is using them"""
+        lock_path = os.path.join(self.cachedir, f"{name}.lock")
+        with open(lock_path, "a") as lockf:
+            try:
+                fcntl.flock(lockf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            for path in (os.path.join(self.cachedir, f"{name}.part"), lock_path):
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+        return True
+
+    @contextlib.contextmanager
+    def _entries(self):
+        os.makedirs(self.cachedir, exist_ok=True)
+        with locked(self.index_path):
+            entries = self._load()
+            self._sync(entries)
+            yield entries
+            atomic_write(self.index_path, json.dumps(entries, indent=1, sort_keys=True))
+
+    def lookup(self, crate, version):
+        name = f"{crate}-{version}.crate"
+        path = os.path.join(self.cachedir, name)
+        if not os.path.isfile(path):
+            return None
+        with self._entries() as entries:
+            entries[name]["atime"] = time.time()
+        return path
+
+    def add(self, path, sha256=None):
+        name = os.path.basename(path)
+        with self._entries() as entries:
+            entries[name] = {"size": os.path.getsize(path), "sha256": sha256, "atime": time.time()}
+            return self._prune(entries, self.max_size, keep=name)
+
+    def _prune(self, entries, max_size, keep=None):
+        partial = self._partial()
+        # Locks of crates which are neither cached nor being downloaded
+        for f in os.listdir(self.cachedir):
+            name = f[:-len(".lock")]
+            if f.endswith(".crate.lock") and name not in entries and name not in partial:
+                self._remove_leftovers(name)
+
+        total = sum(e["size"] for e in entries.values()) + sum(s for s, _ in partial.values())
+        candidates = sorted([(e["atime"], name) for name, e in entries.items()] +
+                            [(mtime, f"{name}.part") for name, (_, mtime) in partial.items()])
+        removed = []
+        for _, name in candidates:
+            if total <= max_size:
+                break
+            if name == keep:
+                continue
+            if name.endswith(".part"):
+                if self._remove_leftovers(name[:-len(".part")]):
+                    total -= partial[name[:-len(".part")]][0]
+                    removed.append(name)
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(os.path.join(self.cachedir, name))
+            self._remove_leftovers(name)
+            total -= entries.pop(name)["size"]
+            removed.append(name)
+        return removed
+
+    def prune(self, max_size=None):
+        with self._entries() as entries:
+            return self._prune(entries, self.max_size if max_size is None else max_size)
+
+    def verify(self, checksum=None):
+        """Remove crates not matching their checksum, return their names
+
+        Crates adopted without a recorded checksum are checked against
+        checksum(name), e.g. the index cksum, and stay unverified if it
+        returns None.
+        """
+        bad = []
+        with self._entries() as entries:
+            for name, entry in sorted(entries.items()):
+                expected = entry["sha256"]
+                if expected is None and checksum is not None:
+                    expected = checksum(name)
+                if expected is None:
+                    continue
+                if sha256_file(os.path.join(self.cachedir, name)) != expected:
+                    bad.append(name)
+                else:
+                    entry["sha256"] = expected
+            for name in bad:
+                os.unlink(os.path.join(self.cachedir, name))
+                self._remove_leftovers(name)
+                del entries[name]
+        return bad
+
+    def stats(self):
+        with self._entries() as entries:
+            partial = self._partial()
+            return {"crates": len(entries),
+                    "size": sum(e["size"] for e in entries.values()),
+                    "partial": sum(s for s, _ in partial.values()),
+                    "max_size": self.max_size,
+                    "unverified": sum(e["sha256"] is None for e in entries.values())}
@@ -0,0 +1,86 @@
+__all__ = ["RUST_ARCHES", "applies"]
+
+import functools
+import re
+
+# %rust_arches from macros.rust-srpm and what rustc reports for them
+RUST_ARCHES = {
+    "x86_64": {"triple": "x86_64-unknown-linux-gnu", "target_arch": "x86_64",
+               "target_pointer_width": "64", "target_endian": "little"},
+    "i686": {"triple": "i686-unknown-linux-gnu", "target_arch": "x86",
+             "target_pointer_width": "32", "target_endian": "little"},
+    "armv7hl": {"triple": "armv7-unknown-linux-gnueabihf", "target_arch": "arm",
+                "target_pointer_width": "32", "target_endian": "little", "target_abi": "eabihf"},
+    "aarch64": {"triple": "aarch64-unknown-linux-gnu", "target_arch": "aarch64",
+                "target_pointer_width": "64", "target_endian": "little"},
+    "ppc64": {"triple": "powerpc64-unknown-linux-gnu", "target_arch": "powerpc64",
+              "target_pointer_width": "64", "target_endian": "big"},
+    "ppc64le": {"triple": "powerpc64le-unknown-linux-gnu", "target_arch": "powerpc64",
+                "target_pointer_width": "64", "target_endian": "little"},
+    "s390x": {"triple": "s390x-unknown-linux-gnu", "target_arch": "s390x",
+              "target_pointer_width": "64", "target_endian": "big"},
+}
+
+_LINUX = {"target_os": "linux", "target_family": "unix", "target_env": "gnu",
+          "target_vendor": "unknown", "target_abi": ""}
+_FLAGS = {"unix": True, "windows": False}
+
+# cfg(windows), cfg(not(unix)), cfg(target_os = "macos") and the like
+# make up nearly all target tables and need no parser
+_SIMPLE_CFG = re.compile(r'cfg\(\s*(not\(\s*)?(\w+)\s*(?:=\s*"([^"]*)"\s*)?(?(1)\)\s*)\)$')
+
+def _option(arch, key, value):
+    """True/False for cfg options known for arch, None for anything else"""
+    if value is None:
+        return _FLAGS.get(key)
+    known = {**_LINUX, **arch}
+    if key not in known or key == "triple":
+        # target_feature, target_has_atomic, custom --cfg flags, ...
+        return None
+    return known[key] == value
+
+def _not(value):
+    return None if value is None else not value
+
+def _eval_tree(arch, tree):
+    kind = tree.getName()
+    if kind == "option":
+        return _option(arch, tree.option, None)
+    if kind == "assign":
+        return _option(arch, tree.option, tree.value)
+    op, args = tree[0], [_eval_tree(arch, item) for item in tree[1:]]
+    if op == "cfg":
+        return args[0]
+    if op == "not":
+        return _not(args[0])
+    if op == "any":
+        return True if True in args else None if None in args else False
+    if op == "all":
+        return False if False in args else None if None in args else True
+    return None
+
+def _evaluate(arch, target):
+    if not target.startswith("cfg("):
+        return target == arch["triple"]
+    m = _SIMPLE_CFG.match(target)
+    if m is not None:
+        negated, key, value = m.groups()
+        result = _option(arch, key, value)
+        return _not(result) if negated else result
+    try:
+        import rustcfg
+        tree = rustcfg.cfg_grammar().parseString(target)
+    except Exception:
+        return None
+    return _eval_tree(arch, tree)
+
+@functools.lru_cache(maxsize=None)
+def applies(target):
+    """Whether a dependency for target can be used on any of RUST_ARCHES
+
+    Only expressions which are false for every architecture are rejected,
+    unknown cfg options count as possibly true.
+    """
+    if target is None:
+        return True
+    return any(_evaluate(arch, target) is not False for arch in RUST_ARCHES.values())
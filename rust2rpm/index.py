@@ -0,0 +1,87 @@
+__all__ = ["CrateIndex"]
+
+import functools
+import json
+import os
+
+def _prefix(name):
+    if len(name) <= 2:
+        return str(len(name))
+    if len(name) == 3:
+        return f"3/{name[0]}"
+    return f"{name[:2]}/{name[2:4]}"
+
+def index_path(name):
+    """Relative path of a crate in the crates.io index layout"""
+    name = name.lower()
+    return f"{_prefix(name)}/{name}"
+
+class CrateIndex:
+    """Read-only view of a crates.io index
+
+    location is either a directory (a checkout of the git index or a
+    mirror of the sparse one) or an http(s) URL of a sparse index.
+    Entries are loaded per crate on first use and kept in memory.
+    """
+    def __init__(self, location, session=None):
+        if location.startswith("sparse+"):
+            location = location[len("sparse+"):]
+        self.location = location.rstrip("/")
+        self.remote = self.location.startswith(("http://", "https://"))
+        if self.remote and session is None:
+            import requests
+            session = requests.Session()
+        self.session = session
+
+    def _read(self, relpath):
+        if self.remote:
+            req = self.session.get(f"{self.location}/{relpath}")
+            if req.status_code == 404:
+                return None
+            req.raise_for_status()
+            return req.text
+        try:
+            with open(os.path.join(self.location, relpath)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @functools.lru_cache(maxsize=None)
+    def entries(self, crate):
+        text = self._read(index_path(crate))
+        if text is None:
+            raise LookupError(f"Crate {crate!r} not found in index {self.location}")
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    def versions(self, crate):
+        """Versions newest first, in the shape of the crates.io versions API"""
+        versions = [{"num": e["vers"], "yanked": e["yanked"], "checksum": e["cksum"]}
+                    for e in self.entries(crate)]
+        import semantic_version as semver
+        versions.sort(key=lambda v: semver.Version(v["num"]), reverse=True)
+        return versions
+
+    def checksum(self, crate, version):
+        for e in self.entries(crate):
+            if e["vers"] == version:
+                return e["cksum"]
+        raise LookupError(f"Version {version} of {crate!r} not found in index {self.location}")
+
+    @functools.lru_cache(maxsize=None)
+    def _config(self):
+        text = self._read("config.json")
+        return json.loads(text) if text is not None else {}
+
+    def download_url(self, crate, version):
+        """Download URL announced by the index, or None"""
+        dl = self._config().get("dl")
+        if dl is None:
+            return None
+        markers = ("{crate}", "{version}", "{prefix}", "{lowerprefix}", "{sha256-checksum}")
+        if not any(m in dl for m in markers):
+            return f"{dl}/{crate}/{version}/download"
+        return (dl.replace("{crate}", crate)
+                  .replace("{version}", version)
+                  .replace("{prefix}", _prefix(crate))
+                  .replace("{lowerprefix}", _prefix(crate.lower()))
+                  .replace("{sha256-checksum}", self.checksum(crate, version)))
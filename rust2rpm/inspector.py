@@ -1,12 +1,137 @@
 import argparse
+import functools
+import json
+import os
 import sys
 
-from . import Metadata
+from . import Metadata, timings
+from .cache import ManifestCache, atomic_write, sha256_file
+from .manifest import is_virtual_manifest, is_workspace_root
 from .metadata import normalize_deps
 
+def _deps(deps):
+    return sorted(normalize_deps(deps))
+
+def _generator_data(md):
+    # What the provides/requires generators ask for
+    features = sorted(f for f in md.dependencies if f is not None)
+    return {
+        "name": md.name,
+        "version": md.version,
+        "features": features,
+        "provides": {f or "": str(md.provides(f)) for f in [None] + features},
+        "requires": {f or "": ["cargo"] + _deps(md.requires(f)) for f in [None] + features},
+    }
+
+def to_json(md):
+    data = _generator_data(md)
+    return {
+        **data,
+        "target_kinds": sorted(set(tgt.kind for tgt in md.targets)),
+        "build_requires": {f or "": ["rust-packaging"] + _deps(md.requires(f, resolve=True))
+                           for f in [None] + data["features"]},
+        "test_requires": _deps(md.dev_dependencies),
+    }
+
+# Written next to Cargo.toml by %cargo_install, so that the dependency
+# generators don't have to parse the manifest again. It is shipped in
+# every -devel package, so it only holds what -n/-v/-l/-P/-R print.
+SIDECAR = ".rust2rpm.json"
+SIDECAR_FORMAT = 2
+
+def _sidecar_path(f):
+    return os.path.join(os.path.dirname(f), SIDECAR)
+
+def write_sidecar(f, md):
+    st = os.stat(f)
+    # Shipped in -devel packages, so it has to be world readable
+    atomic_write(_sidecar_path(f), json.dumps({"format": SIDECAR_FORMAT,
+                                               "size": st.st_size,
+                                               "sha256": sha256_file(f),
+                                               "metadata": _generator_data(md)}),
+                 perms=0o644)
+
+def read_sidecar(f):
+    """Generator data stored for f, None if missing or stale"""
+    try:
+        with open(_sidecar_path(f)) as fobj:
+            sidecar = json.load(fobj)
+        if (sidecar.get("format") != SIDECAR_FORMAT or
+                sidecar["size"] != os.path.getsize(f) or sidecar["sha256"] != sha256_file(f)):
+            return None
+        return sidecar["metadata"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def _sidecar_answers(data, args):
+    return (not (args.json or args.target_kinds or args.build_requires or args.test_requires)
+            and (args.feature or "") in data["provides"])
+
+def _output_sidecar(data, args):
+    # Same output as _output(), from the precomputed generator data
+    out = []
+    feature = args.feature or ""
+
+    if args.name:
+        out.append(data["name"])
+    if args.version:
+        out.append(data["version"])
+    if args.list_features:
+        out.extend(data["features"])
+    if args.provides:
+        out.append(data["provides"][feature])
+    if args.requires:
+        out.append("\n".join(data["requires"][feature]))
+    return out
+
+def inspect(f, args, cache=None):
+    data = None if args.no_sidecar or args.write_sidecar else read_sidecar(f)
+    if data is not None and _sidecar_answers(data, args):
+        with timings.phase("output", file=f, sidecar=True):
+            return _output_sidecar(data, args)
+
+    with timings.phase("read-manifest", file=f):
+        md = Metadata.from_file(f, cache=cache)
+    if args.write_sidecar:
+        write_sidecar(f, md)
+    with timings.phase("output", file=f, pruned=len(md.pruned_dependencies)):
+        return _output(md, args)
+
+def _output(md, args):
+    out = []
+
+    def print_deps(deps):
+        if len(deps) > 0:
+            out.append("\n".join(sorted(normalize_deps(deps))))
+
+    if args.json:
+        out.append(json.dumps(to_json(md)))
+    if args.name:
+        out.append(md.name)
+    if args.version:
+        out.append(md.version)
+    if args.target_kinds:
+        out.append("\n".join(set(tgt.kind for tgt in md.targets)))
+    if args.list_features:
+        for f in sorted(f for f in md.dependencies if f is not None):
+            out.append(f)
+    if args.provides:
+        out.append(str(md.provides(args.feature)))
+    if args.requires:
+        # Someone should own /usr/share/cargo/registry
+        out.append("cargo")
+        print_deps(md.requires(args.feature))
+    if args.build_requires:
+        out.append("rust-packaging")
+        print_deps(md.requires(args.feature or "default", resolve=True))
+    if args.test_requires:
+        print_deps(md.dev_dependencies)
+    return out
+
 def main():
     parser = argparse.ArgumentParser()
-    group = parser.add_mutually_exclusive_group(required=True)
+    # Queries can be combined, their output follows the order below
+    group = parser.add_argument_group("queries")
     group.add_argument("-n", "--name", action="store_true", help="Print name")
     group.add_argument("-v", "--version", action="store_true", help="Print version")
     group.add_argument("-t", "--target-kinds", action="store_true", help="Print target kinds")
@@ -15,42 +140,86 @@ def main():
     group.add_argument("-R", "--requires", action="store_true", help="Print Requires")
     group.add_argument("-BR", "--build-requires", action="store_true", help="Print BuildRequires")
     group.add_argument("-TR", "--test-requires", action="store_true", help="Print TestRequires")
+    group.add_argument("--json", action="store_true",
+                       help="Print everything above for all features as one JSON line")
+    group.add_argument("--write-sidecar", action="store_true",
+                       help=f"Store what -n/-v/-l/-P/-R print in {SIDECAR} next to the manifest")
     parser.add_argument("-f", "--feature", help="Feature to work on")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use the metadata cache")
+    parser.add_argument("--no-sidecar", action="store_true",
+                        help=f"Parse the manifest even if there is an up to date {SIDECAR}")
+    parser.add_argument("--workspace", action="store_true",
+                        help="Answer for all members of workspace roots which are packages themselves "
+                             "(virtual manifests always answer for their members)")
+    parser.add_argument("--multifile", action="store_true",
+                        help="Prefix output for each file with ';<file>' (rpm multifile protocol)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="Number of manifests to process in parallel")
+    parser.add_argument("--timings", metavar="FILE",
+                        default=os.getenv("RUST2RPM_TIMINGS"),
+                        help="Write wall/CPU time of each phase as JSON lines to FILE, '-' for stderr "
+                             "(default: $RUST2RPM_TIMINGS)")
+    parser.add_argument("--profile", metavar="FILE", default=os.getenv("RUST2RPM_PROFILE"),
+                        help="Dump cProfile stats to FILE, {pid} is replaced with the process id "
+                             "(default: $RUST2RPM_PROFILE)")
     parser.add_argument("file", nargs="*", help="Path(s) to Cargo.toml")
     args = parser.parse_args()
+    if not any((args.name, args.version, args.target_kinds, args.list_features,
+                args.provides, args.requires, args.build_requires, args.test_requires,
+                args.json, args.write_sidecar)):
+        parser.error("at least one query is required")
 
     files = args.file or sys.stdin.readlines()
+    files = [f.rstrip() for f in files if f.strip()]
 
     if not args.feature:
         args.feature = None
 
-    def print_deps(deps):
-        if len(deps) > 0:
-            print("\n".join(sorted(normalize_deps(deps))))
+    timings.configure(args.timings, "cargo-inspector")
+    with timings.profiled(args.profile), timings.phase("main", files=len(files)):
+        run(files, args)
+
+def inspect_workspace(f, args):
+    """Output for every member of the workspace at f, from one cargo call"""
+    with timings.phase("cargo-metadata", file=f):
+        members = Metadata.from_workspace(f)
+    if args.write_sidecar:
+        for md in members:
+            write_sidecar(md.manifest_path, md)
+    with timings.phase("output", file=f):
+        return [(md.manifest_path, _output(md, args)) for md in members]
+
+def _inspect_worker(f, args, cache):
+    # Configured per call, ProcessPoolExecutor(initializer=) needs Python 3.7
+    timings.configure(args.timings, "cargo-inspector")
+    return inspect(f, args, cache)
+
+def run(files, args):
+    cache = None if args.no_cache else ManifestCache()
+
+    # A root package answers for itself unless all members are asked for
+    workspaces = {f: inspect_workspace(f, args) for f in files
+                  if is_virtual_manifest(f) or (args.workspace and is_workspace_root(f))}
+    manifests = [f for f in files if f not in workspaces]
+
+    # The profiler only sees this process
+    if args.jobs > 1 and len(manifests) > 1 and not args.profile:
+        import concurrent.futures
+        work = functools.partial(_inspect_worker, args=args, cache=cache)
+        with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+            chunksize = max(1, len(manifests) // (args.jobs * 4))
+            results = list(executor.map(work, manifests, chunksize=chunksize))
+    else:
+        results = map(functools.partial(inspect, args=args, cache=cache), manifests)
+    results = dict(zip(manifests, results))
 
     for f in files:
-        f = f.rstrip()
-        md = Metadata.from_file(f)
-        if args.name:
-            print(md.name)
-        if args.version:
-            print(md.version)
-        if args.target_kinds:
-            print("\n".join(set(tgt.kind for tgt in md.targets)))
-        if args.list_features:
-            for f in sorted(f for f in md.dependencies if f is not None):
-                print(f)
-        if args.provides:
-            print(md.provides(args.feature))
-        if args.requires:
-            # Someone should own /usr/share/cargo/registry
-            print("cargo")
-            print_deps(md.requires(args.feature))
-        if args.build_requires:
-            print("rust-packaging")
-            print_deps(md.requires(args.feature or "default", resolve=True))
-        if args.test_requires:
-            print_deps(md.dev_dependencies)
+        outputs = workspaces[f] if f in workspaces else [(f, results[f])]
+        for path, out in outputs:
+            if args.multifile:
+                print(f";{path}")
+            for line in out:
+                print(line)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,221 @@
+__all__ = ["UnsupportedManifest", "is_virtual_manifest", "is_workspace_root", "read_manifest"]
+
+import functools
+import os
+import re
+
+class UnsupportedManifest(Exception):
+    """Raised when the manifest has to be handed over to cargo"""
+
+# Cheap check before parsing, nearly all manifests have no workspace table
+_WORKSPACE_TABLE = re.compile(rb"^\s*(\[workspace[\].]|workspace\s*=)", re.MULTILINE)
+
+@functools.lru_cache(maxsize=None)
+def _toml():
+    # Imported on first use, cached cargo-inspector queries never need it
+    try:
+        import tomllib
+        return tomllib, "rb"
+    except ImportError:
+        pass
+    try:
+        import toml
+        return toml, "r"
+    except ImportError:
+        return None, None
+
+def _load(path):
+    toml, mode = _toml()
+    if toml is None:
+        raise UnsupportedManifest("no TOML parser available")
+    try:
+        with open(path, mode) as f:
+            return toml.load(f)
+    except (ValueError, TypeError) as e:
+        # tomllib.TOMLDecodeError and toml.TomlDecodeError are ValueErrors
+        raise UnsupportedManifest(f"failed to parse {path}: {e}") from e
+
+def _get(table, key, default=None):
+    # Cargo accepts both dashed and underscored spellings for most keys
+    if key in table:
+        return table[key]
+    return table.get(key.replace("-", "_"), default)
+
+def _check_not_inherited(value, what):
+    if isinstance(value, dict) and value.get("workspace"):
+        raise UnsupportedManifest(f"{what} is inherited from workspace")
+    return value
+
+def _normalize_req(req):
+    if req is None:
+        return "*"
+    parts = []
+    for part in req.split(","):
+        part = part.replace(" ", "")
+        if part[:1].isdigit():
+            # Bare versions are caret requirements
+            part = f"^{part}"
+        parts.append(part)
+    return ", ".join(parts)
+
+def _dependency(key, spec, kind, target):
+    _check_not_inherited(spec, f"dependency {key!r}")
+    if isinstance(spec, str):
+        spec = {"version": spec}
+    package = spec.get("package")
+    return {
+        "name": package or key,
+        "req": _normalize_req(spec.get("version")),
+        "kind": kind,
+        "rename": key if package is not None else None,
+        "optional": spec.get("optional", False),
+        "uses_default_features": _get(spec, "default-features", True),
+        "features": list(spec.get("features", [])),
+        "target": target,
+    }
+
+def _dependencies(toml):
+    tables = [(None, toml)]
+    tables.extend((target, spec) for target, spec in toml.get("target", {}).items())
+
+    deps = []
+    for target, table in tables:
+        for section, kind in (("dependencies", None),
+                              ("build-dependencies", "build"),
+                              ("dev-dependencies", "dev")):
+            for key, spec in _get(table, section, {}).items():
+                deps.append(_dependency(key, spec, kind, target))
+    return deps
+
+def _features(toml, deps):
+    features = {name: list(fdeps) for name, fdeps in toml.get("features", {}).items()}
+
+    # Optional dependencies which are never referenced through "dep:"
+    # get an implicit feature of the same name
+    explicit = {f for fdeps in features.values() for f in fdeps if f.startswith("dep:")}
+    for dep in deps:
+        if not dep["optional"]:
+            continue
+        key = dep["rename"] or dep["name"]
+        if f"dep:{key}" not in explicit and key not in features:
+            features[key] = [f"dep:{key}"]
+    return features
+
+def _readme(root, package):
+    readme = package.get("readme")
+    if readme is False:
+        return None
+    if readme is True:
+        return "README.md"
+    if readme is not None:
+        return readme
+    for name in ("README.md", "README.txt", "README"):
+        if os.path.isfile(os.path.join(root, name)):
+            return name
+    return None
+
+def _infer_targets(root, dirname, kind):
+    path = os.path.join(root, dirname)
+    if not os.path.isdir(path):
+        return []
+    inferred = []
+    for entry in sorted(os.listdir(path)):
+        full = os.path.join(path, entry)
+        if entry.endswith(".rs") and os.path.isfile(full):
+            inferred.append((entry[:-3], kind))
+        elif os.path.isfile(os.path.join(full, "main.rs")):
+            inferred.append((entry, kind))
+    return inferred
+
+def _targets(root, toml, package):
+    edition = package.get("edition", "2015")
+    name = package["name"]
+    targets = []
+
+    lib = toml.get("lib")
+    if lib is not None or os.path.isfile(os.path.join(root, "src", "lib.rs")):
+        lib = lib or {}
+        if _get(lib, "proc-macro", False):
+            kinds = ["proc-macro"]
+        else:
+            kinds = list(_get(lib, "crate-type", ["lib"]))
+        targets.append({"name": lib.get("name", name.replace("-", "_")),
+                        "kind": kinds})
+
+    for section, autokey, kind, inferred in (
+            ("bin", "autobins", "bin",
+             ([(name, "bin")] if os.path.isfile(os.path.join(root, "src", "main.rs")) else []) +
+             _infer_targets(root, os.path.join("src", "bin"), "bin")),
+            ("example", "autoexamples", "example", _infer_targets(root, "examples", "example")),
+            ("test", "autotests", "test", _infer_targets(root, "tests", "test")),
+            ("bench", "autobenches", "bench", _infer_targets(root, "benches", "bench"))):
+        explicit = toml.get(section, [])
+        names = [t.get("name", name) for t in explicit]
+        # In edition 2015, declaring any target of a kind disables inference
+        if not package.get(autokey, True) or (edition == "2015" and explicit):
+            inferred = []
+        names.extend(n for n, _ in inferred if n not in names)
+        targets.extend({"name": n, "kind": [kind]} for n in names)
+
+    build = package.get("build")
+    if build is None:
+        build = os.path.isfile(os.path.join(root, "build.rs"))
+    if build:
+        targets.append({"name": "build-script-build", "kind": ["custom-build"]})
+
+    return targets
+
+def read_manifest(path):
+    """Produce the same structure as `cargo read-manifest` does
+
+    Only the keys consumed by Metadata.from_json are filled in.
+    UnsupportedManifest is raised for anything this reader does not
+    understand, in which case cargo should be asked instead.
+    """
+    toml = _load(path)
+    root = os.path.dirname(os.path.abspath(path))
+
+    package = toml.get("package", toml.get("project"))
+    if package is None:
+        raise UnsupportedManifest(f"{path} has no [package] section")
+    for key, value in package.items():
+        _check_not_inherited(value, f"package.{key}")
+    if "name" not in package or "version" not in package:
+        raise UnsupportedManifest(f"{path} has no name or version")
+
+    deps = _dependencies(toml)
+    return {
+        "name": package["name"],
+        "version": package["version"],
+        "license": package.get("license"),
+        "license_file": package.get("license-file"),
+        "readme": _readme(root, package),
+        "description": package.get("description"),
+        "dependencies": deps,
+        "features": _features(toml, deps),
+        "targets": _targets(root, toml, package),
+        "manifest_path": os.path.abspath(path),
+    }
+
+def _workspace_manifest(path):
+    with open(path, "rb") as f:
+        if _WORKSPACE_TABLE.search(f.read()) is None:
+            return None
+    try:
+        toml = _load(path)
+    except UnsupportedManifest:
+        return None
+    return toml if "workspace" in toml else None
+
+def is_workspace_root(path):
+    """Whether path is a workspace manifest with members besides itself"""
+    toml = _workspace_manifest(path)
+    if toml is None:
+        return False
+    # A [package] with an empty [workspace] only opts out of a parent workspace
+    return "package" not in toml or bool(toml["workspace"].get("members"))
+
+def is_virtual_manifest(path):
+    """Whether path is a workspace manifest without a [package] of its own"""
+    toml = _workspace_manifest(path)
+    return toml is not None and "package" not in toml
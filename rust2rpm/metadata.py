@@ -1,27 +1,108 @@
 __all__ = ["Dependency", "Metadata"]
 
 import collections
-import copy
+import functools
 import json
-import subprocess
+import operator
+import re
+import weakref
 
-import semantic_version as semver
-import rustcfg
+from . import cfg, manifest
 
-class Target:
-    def __init__(self, name, kind):
-        self.name = name
-        self.kind = kind
+# semantic_version and subprocess are imported where they are needed:
+# cargo-inspector is started by rpm for every package and most queries
+# never get that far.
+
+_SIMPLE_REQ = re.compile(r"(\^|~|=|>=|>|<=|<)?(0|[1-9][0-9]*)(?:\.(0|[1-9][0-9]*)(?:\.(0|[1-9][0-9]*))?)?$")
+
+_OPERATORS = {
+    "=": operator.eq,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+}
+
+@functools.lru_cache(maxsize=4096)
+def _parse_version(version):
+    import semantic_version as semver
+    return semver.Version(version)
+
+def satisfies(version, reqs):
+    """Whether version (a string) meets requirements as normalized by Dependency
+
+    version may also be in the RPM form used for registry directories and
+    provides, with "~" instead of "-" before the prerelease.
+    """
+    version = _parse_version(version.replace("~", "-"))
+    return all(_OPERATORS[op](version, _parse_version(bound.replace("~", "-")))
+               for op, bound in reqs)
+
+class _Value:
+    """Immutable value object; structurally equal instances are shared"""
+    __slots__ = ("_hash", "__weakref__")
+    _fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._instances = weakref.WeakValueDictionary()
+
+    @classmethod
+    def _intern(cls, *values):
+        self = cls._instances.get(values)
+        if self is None:
+            self = object.__new__(cls)
+            for field, value in zip(cls._fields, values):
+                object.__setattr__(self, field, value)
+            object.__setattr__(self, "_hash", hash(values))
+            cls._instances[values] = self
+        return self
+
+    def _key(self):
+        return tuple(getattr(self, field) for field in self._fields)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._hash == other._hash and self._key() == other._key()
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return type(self), self._key()
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+class Target(_Value):
+    __slots__ = _fields = ("name", "kind")
+
+    def __new__(cls, name, kind):
+        return cls._intern(name, kind)
 
     def __repr__(self):
         return f"<Target {self.name} ({self.kind})>"
 
-class Dependency:
-    def __init__(self, name, req=None, features=(), optional=False):
-        self.name = name
-        self.req = req
-        self.features = features
-        self.optional = optional
+class Dependency(_Value):
+    __slots__ = _fields = ("name", "req", "features", "optional")
+
+    def __new__(cls, name, req=None, features=(), optional=False):
+        return cls._intern(name, req, frozenset(features), optional)
+
+    def with_features(self, features):
+        return type(self)(self.name, self.req, features, self.optional)
 
     @classmethod
     def from_json(cls, metadata):
@@ -35,7 +116,51 @@ class Dependency:
         return cls(**kwargs)
 
     @staticmethod
+    def _normalize_simple_req(req):
+        # Plain numeric versions with a single operator cover nearly all
+        # requirements seen in the wild and need no semantic_version
+        reqs = []
+        for part in req.split(","):
+            m = _SIMPLE_REQ.match(part.replace(" ", ""))
+            if m is None:
+                return None
+            op, major, minor, patch = m.groups()
+            coerced = f"{major}.{minor or 0}.{patch or 0}"
+            major = int(major)
+            if op == "^":
+                if major == 0 and minor is not None:
+                    if minor != "0" or patch is None:
+                        upper = f"0.{int(minor) + 1}.0"
+                    else:
+                        upper = f"0.0.{int(patch) + 1}"
+                else:
+                    upper = f"{major + 1}.0.0"
+                reqs.append((">=", coerced))
+                reqs.append(("<", upper))
+            elif op == "~":
+                if minor is None:
+                    upper = f"{major + 1}.0.0"
+                else:
+                    upper = f"{major}.{int(minor) + 1}.0"
+                reqs.append((">=", coerced))
+                reqs.append(("<", upper))
+            else:
+                reqs.append((op or "=", coerced))
+        return tuple(reqs)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def _normalize_req(req):
+        if req == "*":
+            return ()
+        reqs = Dependency._normalize_simple_req(req)
+        if reqs is None:
+            reqs = Dependency._normalize_semver_req(req)
+        return reqs
+
+    @staticmethod
+    def _normalize_semver_req(req):
+        import semantic_version as semver
         if "*" in req and req != "*":
             raise NotImplementedError(f"'*' is not supported: {req}")
         spec = semver.Spec(req.replace(" ", ""))
@@ -66,14 +191,14 @@ class Dependency:
                 else:
                     upper = ver.next_major()
                 reqs.append((">=", coerced))
-                reqs.append(("<", upper))
+                reqs.append(("<", str(upper)))
             elif req.kind == req.KIND_TILDE:
                 if ver.minor is None:
                     upper = ver.next_major()
                 else:
                     upper = ver.next_minor()
                 reqs.append((">=", coerced))
-                reqs.append(("<", upper))
+                reqs.append(("<", str(upper)))
             elif req.kind in (req.KIND_SHORTEQ,
                               req.KIND_GT,
                               req.KIND_GTE,
@@ -82,9 +207,10 @@ class Dependency:
                 reqs.append((str(req.kind), coerced))
             else:
                 raise AssertionError(f"Found unhandled kind: {req.kind}")
-        return reqs
+        return tuple(reqs)
 
     @staticmethod
+    @functools.lru_cache(maxsize=16384)
     def _apply_reqs(name, reqs, feature=None):
         fstr = f"/{feature}" if feature is not None else ""
         cap = f"crate({name}{fstr})"
@@ -96,6 +222,10 @@ class Dependency:
         else:
             return deps
 
+    def matches(self, version):
+        """Whether version (a string) satisfies this dependency's requirement"""
+        return satisfies(version, self._normalize_req(self.req))
+
     def normalize(self):
         return [self._apply_reqs(self.name, self._normalize_req(self.req), feature)
                 for feature in self.features or (None,)]
@@ -121,6 +251,9 @@ class Metadata:
         self.targets = set()
         self.dependencies = {}
         self.dev_dependencies = set()
+        self.pruned_dependencies = []
+        self.manifest_path = None
+        self._closures = None
 
     @classmethod
     def from_json(cls, metadata):
@@ -131,10 +264,19 @@ class Metadata:
         self.license_file = md["license_file"]
         self.readme = md["readme"]
         self.description = md.get("description")
+        self.manifest_path = md.get("manifest_path")
+
+        # Dependencies of targets none of the %rust_arches can be are dropped
+        dependencies = []
+        for dep in md["dependencies"]:
+            if cfg.applies(dep.get("target")):
+                dependencies.append(dep)
+            else:
+                self.pruned_dependencies.append((dep["name"], dep["target"]))
 
         # dependencies + build-dependencies → runtime
         deps_by_name = collections.defaultdict(list)
-        for dep in md["dependencies"]:
+        for dep in dependencies:
             if dep["kind"] == "dev":
                 continue
             deps_by_name[dep["name"]].append(Dependency.from_json(dep))
@@ -149,9 +291,8 @@ class Metadata:
                 else:
                     pkg, _, f = dep.partition("/")
                     for dep in deps_by_name[pkg]:
-                        dep = copy.deepcopy(dep)
                         if f:
-                            dep.features = {f}
+                            dep = dep.with_features({f})
                         deps.add(dep)
             deps_by_feature[feature] = (features, deps)
 
@@ -160,9 +301,9 @@ class Metadata:
             fdeps = set()
             for dep in deps:
                 if dep.optional:
-                    fdeps.add(copy.deepcopy(dep))
+                    fdeps.add(dep)
                 else:
-                    mandatory_deps.add(copy.deepcopy(dep))
+                    mandatory_deps.add(dep)
             if fdeps:
                 deps_by_feature[name] = ({None}, fdeps)
         deps_by_feature[None] = (set(), mandatory_deps)
@@ -172,7 +313,7 @@ class Metadata:
 
         self.dependencies = deps_by_feature
         self.dev_dependencies = {Dependency.from_json(dep)
-                                 for dep in md["dependencies"]
+                                 for dep in dependencies
                                  if dep["kind"] == "dev"}
 
         self.targets = {Target(tgt["name"], tgt["kind"][0])
@@ -180,11 +321,32 @@ class Metadata:
 
         return self
 
+    @staticmethod
+    def _read_manifest(path):
+        try:
+            return manifest.read_manifest(path)
+        except manifest.UnsupportedManifest:
+            import subprocess
+            return json.loads(subprocess.check_output(["cargo", "read-manifest",
+                                                       f"--manifest-path={path}"]))
+
     @classmethod
-    def from_file(cls, path):
-        metadata = subprocess.check_output(["cargo", "read-manifest",
-                                            f"--manifest-path={path}"])
-        return cls.from_json(json.loads(metadata))
+    def from_file(cls, path, cache=None):
+        if cache is not None:
+            metadata = cache.get(path, cls._read_manifest)
+        else:
+            metadata = cls._read_manifest(path)
+        return cls.from_json(metadata)
+
+    @classmethod
+    def from_workspace(cls, path):
+        """Metadata of all members of the workspace at path, from one cargo call"""
+        import subprocess
+        metadata = json.loads(subprocess.check_output(["cargo", "metadata", "--no-deps",
+                                                       "--format-version=1",
+                                                       f"--manifest-path={path}"]))
+        members = set(metadata["workspace_members"])
+        return [cls.from_json(pkg) for pkg in metadata["packages"] if pkg["id"] in members]
 
     @property
     def all_dependencies(self):
@@ -195,22 +357,76 @@ class Metadata:
             raise KeyError(f"Feature {feature!r} doesn't exist")
         return Dependency(self.name, f"={self._version}", features={feature})
 
-    @classmethod
-    def _resolve(cls, deps_by_feature, feature):
-        all_features = set()
-        all_deps = set()
-        ff, dd = copy.deepcopy(deps_by_feature[feature])
-        all_features |= ff
-        all_deps |= dd
-        for f in ff:
-            ff1, dd1 = cls._resolve(deps_by_feature, f)
-            all_features |= ff1
-            all_deps |= dd1
-        return all_features, all_deps
+    @staticmethod
+    def _resolve_all(deps_by_feature):
+        # Tarjan's algorithm, iteratively. Strongly connected components
+        # come out in reverse topological order, so closures of everything
+        # a component points to are known by the time it is emitted.
+        index = {}
+        lowlink = {}
+        component = {}
+        closures = {}
+        stack = []
+        on_stack = set()
+
+        for root in deps_by_feature:
+            if root in index:
+                continue
+            work = [(root, iter(deps_by_feature[root][0]))]
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = lowlink[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(deps_by_feature[child][0])))
+                        break
+                    elif child in on_stack:
+                        lowlink[node] = min(lowlink[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+                    if lowlink[node] != index[node]:
+                        continue
+                    members = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        members.append(member)
+                        if member == node:
+                            break
+                    features = set()
+                    deps = set()
+                    for member in members:
+                        component[member] = node
+                    for member in members:
+                        ff, dd = deps_by_feature[member]
+                        features |= ff
+                        deps |= dd
+                        for f in ff:
+                            if component[f] != node:
+                                features |= closures[component[f]][0]
+                                deps |= closures[component[f]][1]
+                    closures[node] = (frozenset(features), frozenset(deps))
+
+        return {feature: closures[component[feature]] for feature in deps_by_feature}
+
+    @property
+    def feature_closures(self):
+        """Transitively enabled features and dependencies of every feature"""
+        if self._closures is None:
+            self._closures = self._resolve_all(self.dependencies)
+        return self._closures
 
     def requires(self, feature=None, resolve=False):
         if resolve:
-            return self._resolve(self.dependencies, feature)[1]
+            return set(self.feature_closures[feature][1])
         else:
             features, deps = self.dependencies[feature]
             fdeps = set(Dependency(self.name, f"={self._version}", features={feature})
@@ -219,3 +435,90 @@ class Metadata:
 
 def normalize_deps(deps):
     return set().union(*(d.normalize() for d in deps))
+
+# Version ranges are (low, low_inclusive, high, high_inclusive); bounds are
+# (parsed, original) version pairs, or None where the range is open
+def _range(reqs):
+    low = high = None
+    low_incl = high_incl = True
+    for op, version in reqs:
+        bound = (_parse_version(version.replace("~", "-")), version)
+        if op in ("=", ">=", ">"):
+            low, low_incl = _max_low((low, low_incl), (bound, op != ">"))
+        if op in ("=", "<=", "<"):
+            high, high_incl = _min_high((high, high_incl), (bound, op != "<"))
+    return low, low_incl, high, high_incl
+
+def _max_low(a, b):
+    if a[0] is None or b[0] is None:
+        return b if a[0] is None else a
+    if a[0][0] != b[0][0]:
+        return a if a[0][0] > b[0][0] else b
+    return a if not a[1] else b
+
+def _min_high(a, b):
+    if a[0] is None or b[0] is None:
+        return b if a[0] is None else a
+    if a[0][0] != b[0][0]:
+        return a if a[0][0] < b[0][0] else b
+    return a if not a[1] else b
+
+def _intersect(a, b):
+    """Range of versions within both a and b, None if there are none"""
+    low, low_incl = _max_low(a[:2], b[:2])
+    high, high_incl = _min_high(a[2:], b[2:])
+    if low is not None and high is not None:
+        if low[0] > high[0] or (low[0] == high[0] and not (low_incl and high_incl)):
+            return None
+    return low, low_incl, high, high_incl
+
+def _range_reqs(r):
+    low, low_incl, high, high_incl = r
+    if low is not None and high is not None and low[0] == high[0]:
+        return (("=", low[1]),)
+    reqs = []
+    if low is not None:
+        reqs.append((">=" if low_incl else ">", low[1]))
+    if high is not None:
+        reqs.append(("<=" if high_incl else "<", high[1]))
+    return tuple(reqs)
+
+def requirements(deps, merge=False):
+    """(name, reqs, feature) of everything normalize_deps or merge_deps emit"""
+    if not merge:
+        return {(d.name, Dependency._normalize_req(d.req), feature)
+                for d in deps for feature in d.features or (None,)}
+
+    ranges = collections.defaultdict(list)
+    for dep in sorted(deps, key=lambda d: (d.name, str(d.req), sorted(d.features, key=str))):
+        r = _range(Dependency._normalize_req(dep.req))
+        for feature in dep.features or (None,):
+            merged = ranges[dep.name, feature]
+            for i, other in enumerate(merged):
+                common = _intersect(r, other)
+                if common is not None:
+                    merged[i] = common
+                    break
+            else:
+                merged.append(r)
+
+    result = set()
+    for (name, feature), merged in ranges.items():
+        for r in merged:
+            if feature is None and any(_intersect(r, other) == other
+                                       for (n, f), others in ranges.items()
+                                       if n == name and f is not None
+                                       for other in others):
+                continue
+            result.add((name, _range_reqs(r), feature))
+    return result
+
+def merge_deps(deps):
+    """Like normalize_deps, with as few requirements as possible
+
+    Requirements on the same crate and feature which one version can
+    satisfy are replaced by their intersection. Requirements on a crate
+    without features are dropped if a requirement on one of its features
+    is narrower, as every feature subpackage requires its crate.
+    """
+    return {Dependency._apply_reqs(*r) for r in requirements(deps, merge=True)}
@@ -0,0 +1,119 @@
+__all__ = ["ProvidesIndex"]
+
+import collections
+import json
+import os
+import re
+
+from .cache import CACHEDIR, atomic_write, locked
+from .metadata import Metadata, satisfies
+
+# As printed by `dnf repoquery --provides` or `rpm -q --provides`
+_PROVIDES_LINE = re.compile(r"^\s*crate\(([^/)]+)(?:/([^)]+))?\)\s*=\s*(\S+)")
+
+def _read_list(path):
+    provides = set()
+    with open(path) as f:
+        for line in f:
+            m = _PROVIDES_LINE.match(line)
+            if m is not None:
+                name, feature, version = m.groups()
+                provides.add((name, feature or "", version))
+    return sorted(provides)
+
+def _read_crate(path):
+    md = Metadata.from_file(os.path.join(path, "Cargo.toml"))
+    return [(md.name, feature or "", md._version) for feature in md.dependencies]
+
+class ProvidesIndex:
+    """Versions of crate(<name>/<feature>) available locally
+
+    Sources are registry directories like /usr/share/cargo/registry, where
+    every crate counts as providing all of its features, and provides lists
+    dumped from repo metadata. Registry entries are only read again when
+    their directory's mtime changed.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(CACHEDIR, "provides.json")
+        self.path = path
+        self.sources = {}
+        self._versions = None
+        try:
+            with open(path) as f:
+                self.sources = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def add_registry(self, path):
+        self.sources.setdefault(os.path.abspath(path), {"type": "registry", "mtime": None,
+                                                        "entries": {}})
+
+    def add_list(self, path):
+        self.sources.setdefault(os.path.abspath(path), {"type": "list", "mtime": None,
+                                                        "provides": []})
+
+    def _update_registry(self, path, source):
+        entries = {}
+        for name in sorted(os.listdir(path)):
+            entry_path = os.path.join(path, name)
+            try:
+                mtime = os.stat(entry_path).st_mtime_ns
+            except OSError:
+                continue
+            entry = source["entries"].get(name)
+            if entry is None or entry["mtime"] != mtime:
+                try:
+                    entry = {"mtime": mtime, "provides": _read_crate(entry_path)}
+                except Exception:
+                    # Not a crate, or one we can't read
+                    entry = {"mtime": mtime, "provides": []}
+                self.scanned += 1
+            entries[name] = entry
+        source["entries"] = entries
+
+    def update(self):
+        """Re-read what changed since the last update, return the number of entries read"""
+        self.scanned = 0
+        for path, source in self.sources.items():
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime == source["mtime"]:
+                continue
+            if source["type"] == "registry":
+                if mtime is None:
+                    source["entries"] = {}
+                else:
+                    self._update_registry(path, source)
+            else:
+                source["provides"] = _read_list(path) if mtime is not None else []
+                self.scanned += 1
+            source["mtime"] = mtime
+        self._versions = None
+        return self.scanned
+
+    def save(self):
+        with locked(self.path):
+            atomic_write(self.path, json.dumps(self.sources, sort_keys=True))
+
+    def _provides(self):
+        for source in self.sources.values():
+            if source["type"] == "registry":
+                for entry in source["entries"].values():
+                    yield from entry["provides"]
+            else:
+                yield from source["provides"]
+
+    def versions(self, name, feature=None):
+        if self._versions is None:
+            self._versions = collections.defaultdict(set)
+            for n, f, version in self._provides():
+                self._versions[n, f].add(version)
+        return self._versions.get((name, feature or ""), set())
+
+    def satisfied(self, name, reqs, feature=None):
+        """Whether any version of crate(name/feature) meets the normalized reqs"""
+        return any(satisfies(version, reqs)
+                   for version in self.versions(name, feature))
@@ -44,16 +44,34 @@ Patch0:         {{ patch_file }}
 ExclusiveArch:  %{rust_arches}
 
 BuildRequires:  rust-packaging
-{# We will put all non-optional and optional dependencies until
+{% if unsatisfied %}
+# FIXME: not available locally:
+  {% for req in unsatisfied %}
+#   {{ req }}
+  {% endfor %}
+{% endif %}
+{# All non-optional and optional dependencies are BuildRequired until
    https://github.com/rust-lang/cargo/issues/5133
-   is solved
-{% set buildrequires = normalize_deps(md.requires("default", resolve=True))|sort %}
+   is solved. With --minimal-buildroot only the chosen features' ones are,
+   and the optional dependencies left out have to be removed from Cargo.toml.
 #}
-{% set buildrequires = normalize_deps(md.all_dependencies)|sort %}
+{% if dropped_optional %}
+# FIXME: optional dependencies which are not BuildRequired, cargo still
+# resolves them, remove them from Cargo.toml (cargo#5133):
+  {% for name in dropped_optional %}
+#   {{ name }}
+  {% endfor %}
+{% endif %}
+{% if pruned %}
+# FIXME: dependencies only used on other platforms which are not
+# BuildRequired, cargo still resolves them, remove them from Cargo.toml:
+  {% for dep in pruned %}
+#   {{ dep }}
+  {% endfor %}
+{% endif %}
 {% for req in buildrequires %}
 BuildRequires:  {{ req }}
 {% endfor %}
-{% set testrequires = normalize_deps(md.dev_dependencies)|sort %}
 {% if testrequires|length > 0 %}
 %if %{with check}
   {% for req in testrequires %}
@@ -101,20 +119,9 @@ Requires:       {{ req }}
 {% endif -%}
 
 {% if include_devel %}
-  {% set features = md.dependencies.keys()|list %}
-  {% do features.remove(None) %}
-  {% do features.remove("default") %}
-  {% set features = features|sort %}
-  {% do features.insert(0, None) %}
-  {% do features.insert(1, "default") %}
-  {% for feature in features %}
-    {% if feature is none %}
-      {% set pkg = "   devel" %}
-      {% set conf_prefix = "lib" %}
-    {% else %}
-      {% set pkg = "-n %%{name}+%s-devel"|format(feature) %}
-      {% set conf_prefix = "lib+%s"|format(feature) %}
-    {% endif %}
+  {% for sub in subpackages %}
+    {% set pkg = sub.pkg %}
+    {% set feature = sub.feature %}
 %package     {{ pkg }}
 Summary:        %{summary}
     {% if rust_group is defined %}
@@ -122,15 +129,15 @@ Group:          {{ rust_group }}
     {% endif %}
 BuildArch:      noarch
     {% if include_provides %}
-Provides:       {{ md.provides(feature) }}
+Provides:       {{ sub.provides }}
     {% endif %}
     {% if include_requires %}
 Requires:       cargo
-      {% for req in md.requires(feature)|map("string")|sort %}
+      {% for req in sub.requires %}
 Requires:       {{ req }}
       {% endfor %}
     {% endif %}
-    {% for req in to_list(distconf.get("%s.requires"|format(conf_prefix)))|sort %}
+    {% for req in sub.extra_requires %}
 Requires:       {{ req }}
     {% endfor %}
 
@@ -164,14 +171,14 @@ which use {% if feature is not none %}"{{ feature }}" feature of {% endif %}"%{c
 %cargo_prep
 
 %build
-%cargo_build
+%cargo_build{{ cargo_args }}
 
 %install
 %cargo_install
 
 %if %{with check}
 %check
-%cargo_test
+%cargo_test{{ cargo_args }}
 %endif
 
 %changelog
@@ -0,0 +1,85 @@
+__all__ = ["configure", "phase", "profiled"]
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+_DEST = None
+_PROGRAM = None
+_LOCK = threading.Lock()
+# time.thread_time() is only available on Python 3.7+
+_cpu_time = getattr(time, "thread_time", time.process_time)
+
+def configure(dest, program=None):
+    """Write phase timings to dest: None (disabled), "-" (stderr) or a file
+
+    Files are appended to, so several processes can share one.
+    """
+    global _DEST, _PROGRAM
+    _DEST = dest or None
+    _PROGRAM = program
+
+def _write(record):
+    line = json.dumps(record, sort_keys=True) + "\n"
+    if _DEST == "-":
+        with _LOCK:
+            sys.stderr.write(line)
+            sys.stderr.flush()
+    else:
+        # A single O_APPEND write keeps lines from different processes whole
+        fd = os.open(_DEST, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+@contextlib.contextmanager
+def phase(name, **info):
+    """Record wall and CPU time spent in the block as one JSON line
+
+    CPU time is per thread where supported, so phases running in the batch
+    thread pool don't count each other's work. Time spent in child processes
+    (cargo, the editor) only shows up as wall time.
+    """
+    if _DEST is None:
+        yield
+        return
+    wall, cpu = time.perf_counter(), _cpu_time()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        record = {"program": _PROGRAM,
+                  "phase": name,
+                  "wall": round(time.perf_counter() - wall, 6),
+                  "cpu": round(_cpu_time() - cpu, 6),
+                  "pid": os.getpid(),
+                  **info}
+        if error is not None:
+            record["error"] = error
+        _write(record)
+
+@contextlib.contextmanager
+def profiled(path):
+    """Run the block under cProfile and dump the stats to path
+
+    "{pid}" in path is replaced with the process id, the dumps can be
+    combined with pstats.Stats.add().
+    """
+    if not path:
+        yield
+        return
+    import cProfile
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path.replace("{pid}", str(os.getpid())))
@@ -19,6 +19,8 @@ ARGS = dict(
         "console_scripts": [
             "rust2rpm = rust2rpm.__main__:main",
             "cargo-inspector = rust2rpm.inspector:main",
+            "rust2rpm-cache = rust2rpm.__main__:cache_main",
+            "rust2rpm-provides = rust2rpm.__main__:provides_main",
         ],
     },
     install_requires=[
@@ -32,6 +34,9 @@ ARGS = dict(
 
         # Rust cfg language parser
         "rustcfg",
+
+        # Cargo.toml parser (tomllib is used on Python 3.11+)
+        "toml; python_version < '3.11'",
     ],
 
     author="Igor Gnatenko",
@@ -1,8 +1,22 @@
+import hashlib
+import io
+import json
+import os
+import pickle
+import shutil
+import stat
+import subprocess
+import sys
+import tarfile
+import types
+
 import pytest
 
 import rust2rpm
+from rust2rpm import inspector
+import rust2rpm.__main__ as r2r
 
-@pytest.mark.parametrize("req, rpmdep", [
+DEPENDENCIES = [
     ("^1.2.3",
      "(crate(test) >= 1.2.3 with crate(test) < 2.0.0)"),
     ("^1.2",
@@ -45,7 +59,756 @@ import rust2rpm
      "(crate(test) >= 0.0.1~alpha.6 with crate(test) < 0.0.2)"),
     ("^0.0.0-alpha.6",
      "(crate(test) >= 0.0.0~alpha.6 with crate(test) < 0.0.1)"),
-])
+]
+
+@pytest.mark.parametrize("req, rpmdep", DEPENDENCIES)
 def test_dependency(req, rpmdep):
     dep = rust2rpm.Dependency("test", req)
     assert str(dep) == rpmdep
+
+@pytest.mark.parametrize("req", [req for req, _ in DEPENDENCIES] +
+                         ["=1.2", "1.2.3", "<= 0.3", "^10.20.30", "~0.0.1", "^0.0"])
+def test_normalize_simple_req(req):
+    simple = rust2rpm.Dependency._normalize_simple_req(req)
+    if simple is not None:
+        assert simple == rust2rpm.Dependency._normalize_semver_req(req)
+
+MANIFESTS = [
+    ("""
+[package]
+name = "foo-bar"
+version = "1.2.3-alpha.1"
+license = "MIT/Apache-2.0"
+description = "A thing"
+
+[lib]
+crate-type = ["rlib", "cdylib"]
+
+[[bin]]
+name = "extra"
+path = "src/extra.rs"
+
+[features]
+default = ["std"]
+std = ["serde/std"]
+nightly = []
+
+[dependencies]
+serde = { version = "1.0", optional = true, default-features = false, features = ["derive"] }
+log = "0.4"
+other = { package = "real-other", version = ">= 1.2, < 1.5" }
+exact = "=1.2.3"
+
+[target.'cfg(windows)'.dependencies]
+winapi = "0.3"
+
+[build-dependencies]
+cc = "1"
+
+[dev-dependencies]
+tempdir = "~0.3"
+""", ["src/lib.rs", "src/main.rs", "src/extra.rs", "src/bin/a.rs",
+      "examples/ex.rs", "tests/t.rs", "build.rs", "README.md"]),
+    ("""
+[package]
+name = "baz"
+version = "0.1.0"
+edition = "2018"
+readme = "docs/README.md"
+license-file = "COPYING"
+
+[[bin]]
+name = "extra"
+path = "src/extra.rs"
+
+[dependencies]
+rand = { version = "0.7", optional = true }
+libc = "0.2"
+""", ["src/main.rs", "src/extra.rs", "src/bin/tool/main.rs", "benches/b.rs"]),
+    ("""
+[package]
+name = "derive"
+version = "0.0.3"
+autoexamples = false
+
+[lib]
+proc-macro = true
+
+[dependencies]
+syn = { version = "1", features = ["full"] }
+""", ["src/lib.rs", "examples/ex.rs", "README"]),
+]
+
+def _summary(md):
+    return {
+        "name": md.name,
+        "version": md.version,
+        "license": md.license,
+        "license_file": md.license_file,
+        "readme": md.readme,
+        "description": md.description,
+        "targets": sorted((tgt.name, tgt.kind) for tgt in md.targets),
+        "features": {feature: sorted(map(str, md.requires(feature)))
+                     for feature in md.dependencies},
+        "dev": sorted(map(str, md.dev_dependencies)),
+    }
+
+def _dep(name, req="^1", kind=None, optional=False, default=True, target=None):
+    return {"name": name, "req": req, "kind": kind, "optional": optional,
+            "uses_default_features": default, "features": [], "target": target}
+
+def _metadata(dependencies, features=None, name="foo", kind="lib"):
+    """Metadata from a minimal read-manifest document"""
+    return rust2rpm.Metadata.from_json({
+        "name": name, "version": "1.0.0", "license": None, "license_file": None,
+        "readme": None, "description": None, "targets": [{"name": name, "kind": [kind]}],
+        "dependencies": dependencies, "features": features or {},
+    })
+
+@pytest.mark.skipif(shutil.which("cargo") is None, reason="cargo is not available")
+@pytest.mark.parametrize("toml, files", MANIFESTS)
+def test_read_manifest(tmp_path, toml, files):
+    for f in files:
+        (tmp_path / f).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / f).touch()
+    path = tmp_path / "Cargo.toml"
+    path.write_text(toml)
+
+    native = rust2rpm.Metadata.from_json(rust2rpm.manifest.read_manifest(str(path)))
+    cargo = subprocess.check_output(["cargo", "read-manifest", f"--manifest-path={path}"])
+    cargo = rust2rpm.Metadata.from_json(json.loads(cargo))
+    assert _summary(native) == _summary(cargo)
+
+def test_read_manifest_workspace_inheritance(tmp_path):
+    path = tmp_path / "Cargo.toml"
+    path.write_text('[package]\nname = "foo"\nversion.workspace = true\n')
+    with pytest.raises(rust2rpm.manifest.UnsupportedManifest):
+        rust2rpm.manifest.read_manifest(str(path))
+
+@pytest.mark.skipif(shutil.which("cargo") is None, reason="cargo is not available")
+def test_workspace(tmp_path, monkeypatch, capsys):
+    (tmp_path / "Cargo.toml").write_text('[workspace]\nmembers = ["a", "b"]\n'
+                                         '[workspace.package]\nversion = "2.1.0"\n')
+    for name, version in (("a", "version.workspace = true"), ("b", 'version = "0.1.0"')):
+        (tmp_path / name / "src").mkdir(parents=True)
+        (tmp_path / name / "src" / "lib.rs").touch()
+        (tmp_path / name / "Cargo.toml").write_text(f'[package]\nname = "ws-{name}"\n{version}\n')
+    assert rust2rpm.manifest.is_workspace_root(str(tmp_path / "Cargo.toml"))
+    assert not rust2rpm.manifest.is_workspace_root(str(tmp_path / "a" / "Cargo.toml"))
+
+    monkeypatch.setattr("sys.argv", ["cargo-inspector", "--multifile", "-P", str(tmp_path / "Cargo.toml")])
+    inspector.main()
+    assert capsys.readouterr().out.splitlines() == [
+        f";{tmp_path}/a/Cargo.toml", "crate(ws-a) = 2.1.0",
+        f";{tmp_path}/b/Cargo.toml", "crate(ws-b) = 0.1.0",
+    ]
+
+    monkeypatch.setattr(r2r, "detect_packager", lambda: "Packager <packager@example.com>")
+    monkeypatch.chdir(tmp_path)
+    args = types.SimpleNamespace(target="fedora", patch=False, stdout=False, template=None,
+                                 no_auto_changelog_entry=False, minimal_buildroot=False, features=None,
+                                 check_provides=None)
+    assert r2r.workspace(args, str(tmp_path / "Cargo.toml")) == 0
+    assert "Version:        2.1.0" in (tmp_path / "rust-ws-a.spec").read_text()
+    assert "Version:        0.1.0" in (tmp_path / "rust-ws-b.spec").read_text()
+
+    # A root package answers for itself only, unless asked for the members
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "lib.rs").touch()
+    (tmp_path / "Cargo.toml").write_text('[package]\nname = "root"\nversion = "1.0.0"\n'
+                                         '[workspace]\nmembers = ["b"]\n')
+    assert not rust2rpm.manifest.is_virtual_manifest(str(tmp_path / "Cargo.toml"))
+    monkeypatch.setattr("sys.argv", ["cargo-inspector", "-n", str(tmp_path / "Cargo.toml")])
+    inspector.main()
+    assert capsys.readouterr().out.splitlines() == ["root"]
+    monkeypatch.setattr("sys.argv", ["cargo-inspector", "--workspace", "-n", str(tmp_path / "Cargo.toml")])
+    inspector.main()
+    assert sorted(capsys.readouterr().out.splitlines()) == ["root", "ws-b"]
+
+def test_manifest_cache(tmp_path):
+    crate = tmp_path / "crate"
+    (crate / "src").mkdir(parents=True)
+    (crate / "src" / "lib.rs").touch()
+    path = crate / "Cargo.toml"
+    path.write_text('[package]\nname = "foo"\nversion = "1.0.0"\n')
+
+    cache = rust2rpm.cache.ManifestCache(str(tmp_path / "cache"))
+    calls = []
+    def loader(p):
+        calls.append(p)
+        return rust2rpm.manifest.read_manifest(p)
+
+    md = rust2rpm.Metadata.from_file(str(path), cache=cache)
+    assert md.version == "1.0.0"
+    for _ in range(2):
+        cache.get(str(path), loader)
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert calls == []
+
+    # Touched, but identical content
+    os.utime(path, ns=(0, 0))
+    cache.get(str(path), loader)
+    assert (cache.hits, cache.misses) == (3, 1)
+
+    path.write_text('[package]\nname = "foo"\nversion = "1.0.1"\n')
+    assert cache.get(str(path), loader)["version"] == "1.0.1"
+    assert (cache.hits, cache.misses) == (3, 2)
+
+    # New targets have to invalidate the entry too
+    (crate / "src" / "main.rs").touch()
+    os.utime(crate / "src", ns=(1, 1))
+    kinds = {t["kind"][0] for t in cache.get(str(path), loader)["targets"]}
+    assert kinds == {"lib", "bin"}
+    assert len(calls) == 2
+
+    # A different reader doesn't see the old entries, which age out
+    cache.version = "other"
+    cache.get(str(path), loader)
+    assert len(calls) == 3
+    entries = list((tmp_path / "cache").glob("*.json"))
+    assert len(entries) == 2
+    old, = (e for e in entries if json.loads(e.read_text())["version"] != "other")
+    os.utime(old, (0, 0))
+    assert cache.prune(force=True) == 1
+    cache.get(str(path), loader)
+    assert len(calls) == 3
+
+def test_inspector_json(tmp_path, monkeypatch, capsys):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "lib.rs").touch()
+    (tmp_path / "src" / "main.rs").touch()
+    path = tmp_path / "Cargo.toml"
+    path.write_text(MANIFESTS[2][0])
+    md = rust2rpm.Metadata.from_file(str(path))
+
+    # %cargo_install reads name, version and target kinds from one run
+    monkeypatch.setattr("sys.argv", ["cargo-inspector", "--no-cache", "-n", "-v", "-t", str(path)])
+    inspector.main()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[:2] == ["derive", "0.0.3"]
+    assert sorted(lines[2:]) == ["bin", "proc-macro"]
+
+    doc = json.loads(json.dumps(inspector.to_json(md)))
+    assert doc["features"] == ["default"]
+    assert doc["provides"]["default"] == "crate(derive/default) = 0.0.3"
+    assert doc["requires"][""] == ["cargo", "(crate(syn/default) >= 1.0.0 with crate(syn/default) < 2.0.0)",
+                                   "(crate(syn/full) >= 1.0.0 with crate(syn/full) < 2.0.0)"]
+    assert doc["build_requires"]["default"][0] == "rust-packaging"
+
+def test_inspector_multifile(tmp_path, monkeypatch, capsys):
+    paths = []
+    for name in ("one", "two", "three"):
+        (tmp_path / name / "src").mkdir(parents=True)
+        (tmp_path / name / "src" / "lib.rs").touch()
+        path = tmp_path / name / "Cargo.toml"
+        path.write_text(f'[package]\nname = "{name}"\nversion = "1.0.0"\n')
+        paths.append(str(path))
+
+    monkeypatch.setattr("sys.stdin", io.StringIO("\n".join(paths) + "\n"))
+    monkeypatch.setattr("sys.argv", ["cargo-inspector", "--multifile", "--jobs=2", "--no-cache", "-P"])
+    inspector.main()
+    assert capsys.readouterr().out.splitlines() == [
+        f";{paths[0]}", "crate(one) = 1.0.0",
+        f";{paths[1]}", "crate(two) = 1.0.0",
+        f";{paths[2]}", "crate(three) = 1.0.0",
+    ]
+
+def test_sidecar(tmp_path, monkeypatch, capsys):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "lib.rs").touch()
+    path = tmp_path / "Cargo.toml"
+    path.write_text(MANIFESTS[2][0])
+
+    def run(*argv):
+        monkeypatch.setattr("sys.argv", ["cargo-inspector", "--no-cache", *argv, str(path)])
+        inspector.main()
+        return capsys.readouterr().out
+
+    run("--write-sidecar")
+    sidecar = json.loads((tmp_path / inspector.SIDECAR).read_text())
+    assert stat.S_IMODE((tmp_path / inspector.SIDECAR).stat().st_mode) == 0o644
+    assert sorted(sidecar["metadata"]) == ["features", "name", "provides", "requires", "version"]
+    assert inspector.read_sidecar(str(path)) is not None
+    for flags in (["-P"], ["-R"], ["-BR"], ["-TR"], ["-R", "-f", "default"], ["--json"]):
+        assert run(*flags) == run("--no-sidecar", *flags)
+
+    path.write_text(MANIFESTS[2][0] + "\n")
+    assert inspector.read_sidecar(str(path)) is None
+
+def test_resolve_features():
+    md = rust2rpm.Metadata("test", "1.0.0")
+    dep = {name: rust2rpm.Dependency(name, "1") for name in "abcde"}
+    md.dependencies = {
+        None: (set(), {dep["a"]}),
+        "default": ({None, "std"}, set()),
+        "std": ({None, "alloc"}, {dep["b"]}),
+        "alloc": ({None}, {dep["c"]}),
+        # cycle
+        "x": ({None, "y"}, {dep["d"]}),
+        "y": ({None, "x", "std"}, {dep["e"]}),
+    }
+    closures = md.feature_closures
+    assert closures[None] == (frozenset(), frozenset({dep["a"]}))
+    assert closures["default"] == ({None, "std", "alloc"}, {dep["a"], dep["b"], dep["c"]})
+    assert closures["x"] == closures["y"] == ({None, "x", "y", "std", "alloc"}, set(dep.values()))
+    assert md.requires("std", resolve=True) == {dep["a"], dep["b"], dep["c"]}
+
+def test_resolve_features_deep():
+    md = rust2rpm.Metadata("test", "1.0.0")
+    md.dependencies = {None: (set(), set())}
+    for i in range(2000):
+        md.dependencies[f"f{i}"] = ({None, f"f{i + 1}"} if i < 1999 else {None}, set())
+    assert len(md.feature_closures["f0"][0]) == 2000
+
+@pytest.mark.parametrize("target, applies", [
+    (None, True),
+    ("cfg(unix)", True),
+    ("cfg(windows)", False),
+    ("cfg(not(windows))", True),
+    ('cfg(target_os = "macos")', False),
+    ('cfg(all(target_arch = "x86_64", target_env = "msvc"))', False),
+    ('cfg(any(target_os = "android", target_os = "linux"))', True),
+    ('cfg(all(target_arch = "wasm32", not(target_os = "wasi")))', False),
+    ('cfg(target_endian = "big")', True),
+    ("cfg(tokio_unstable)", True),
+    ('cfg(not(target_feature = "sse2"))', True),
+    ("x86_64-pc-windows-msvc", False),
+    ("aarch64-unknown-linux-gnu", True),
+])
+def test_cfg_applies(target, applies):
+    assert rust2rpm.cfg.applies(target) == applies
+
+def test_prune_dependencies():
+    md = _metadata([_dep("libc", target="cfg(unix)"), _dep("winapi", target="cfg(windows)"),
+                    _dep("wasm-bindgen-test", target='cfg(target_arch = "wasm32")', kind="dev")])
+    assert {d.name for d in md.all_dependencies} == {"libc"}
+    assert md.dev_dependencies == set()
+    assert md.pruned_dependencies == [("winapi", "cfg(windows)"),
+                                      ("wasm-bindgen-test", 'cfg(target_arch = "wasm32")')]
+
+    args = types.SimpleNamespace(target="fedora", no_auto_changelog_entry=False,
+                                 minimal_buildroot=False, features=None, check_provides=None)
+    kwargs = r2r.template_kwargs(args, "foo", md, packager="P", conf={"fedora": {}})
+    spec = r2r.jinja_env().get_template("main.spec").render(md=md, patch_file=None, **kwargs)
+    assert "# FIXME: dependencies only used on other platforms" in spec
+    assert "#   winapi (cfg(windows))" in spec
+    assert "BuildRequires:  (crate(winapi" not in spec
+
+def test_merge_deps():
+    D = rust2rpm.Dependency
+    deps = {D("foo", "^1.0", features={"default"}), D("foo", "^1.2", features={"default"}),
+            D("foo", "^2", features={"default"}), D("foo", "^1.1"),
+            D("bar", "*"), D("bar", "^0.1", features={"std"}),
+            D("pre", "^1.0.0-beta.2"), D("pre", "^1.0.0-beta.5"),
+            D("baz", ">=0.2, <0.5"), D("baz", "~0.4.1")}
+    assert sorted(rust2rpm.metadata.merge_deps(deps)) == [
+        "(crate(bar/std) >= 0.1.0 with crate(bar/std) < 0.2.0)",
+        "(crate(baz) >= 0.4.1 with crate(baz) < 0.5.0)",
+        "(crate(foo/default) >= 1.2.0 with crate(foo/default) < 2.0.0)",
+        "(crate(foo/default) >= 2.0.0 with crate(foo/default) < 3.0.0)",
+        "(crate(pre) >= 1.0.0~beta.5 with crate(pre) < 2.0.0)",
+    ]
+
+def test_minimal_buildroot(capsys):
+    md = _metadata([_dep("core", default=False), _dep("cc", kind="build", default=False),
+                    _dep("serde", optional=True, default=False),
+                    _dep("rayon", optional=True, default=False)],
+                   {"default": [], "parallel": ["rayon"]})
+    conf = {"fedora": {}}
+    args = types.SimpleNamespace(target="fedora", no_auto_changelog_entry=False,
+                                 minimal_buildroot=True, features=None, check_provides=None)
+    kwargs = r2r.template_kwargs(args, "foo", md, packager="P", conf=conf)
+    assert kwargs["buildrequires"] == ["(crate(cc) >= 1.0.0 with crate(cc) < 2.0.0)",
+                                       "(crate(core) >= 1.0.0 with crate(core) < 2.0.0)"]
+    assert kwargs["cargo_args"] == ""
+    # cargo still needs them (cargo#5133), so they are flagged
+    assert kwargs["dropped_optional"] == ["rayon", "serde"]
+    assert "remove them from Cargo.toml: rayon, serde" in capsys.readouterr().err
+    spec = r2r.jinja_env().get_template("main.spec").render(md=md, patch_file=None, **kwargs)
+    assert "# FIXME: optional dependencies which are not BuildRequired" in spec
+    assert "#   serde" in spec
+
+    args.features = ["parallel"]
+    kwargs = r2r.template_kwargs(args, "foo", md, packager="P", conf=conf)
+    assert "(crate(rayon) >= 1.0.0 with crate(rayon) < 2.0.0)" in kwargs["buildrequires"]
+    assert len(kwargs["buildrequires"]) == 3
+    assert kwargs["cargo_args"] == " -f parallel"
+    assert kwargs["dropped_optional"] == ["serde"]
+
+    args.features = ["missing"]
+    with pytest.raises(ValueError):
+        r2r.template_kwargs(args, "foo", md, packager="P", conf=conf)
+
+def test_dependency_value():
+    dep = rust2rpm.Dependency("test", "^1", features=["std"])
+    assert dep is rust2rpm.Dependency("test", "^1", features={"std"})
+    assert dep.with_features({"std"}) is dep
+    assert len({dep, rust2rpm.Dependency("test", "^1", features=("std",))}) == 1
+    assert dep != rust2rpm.Dependency("test", "^1")
+    with pytest.raises(AttributeError):
+        dep.features = {"alloc"}
+    assert pickle.loads(pickle.dumps(dep)) is dep
+
+class FakeResponse:
+    def __init__(self, content, status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {"Content-Length": str(len(content))}
+        self.headers.update(headers or {})
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f"HTTP {self.status_code}")
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def json(self):
+        return json.loads(self.content)
+
+def test_fetch_resume(tmp_path, monkeypatch):
+    data = os.urandom(100000)
+    checksum = hashlib.sha256(data).hexdigest()
+    requested = []
+    def get(url, stream=False, headers={}):
+        requested.append(headers.get("Range"))
+        if "Range" in headers:
+            offset = int(headers["Range"][6:-1])
+            return FakeResponse(data[offset:], 206)
+        return FakeResponse(data)
+    monkeypatch.setattr(r2r, "session", lambda: types.SimpleNamespace(get=get))
+
+    path = tmp_path / "foo-1.0.0.crate"
+    (tmp_path / "foo-1.0.0.crate.part").write_bytes(data[:30000])
+    r2r.fetch("https://example.com/foo", str(path), checksum, "foo")
+    assert requested == ["bytes=30000-"]
+    assert path.read_bytes() == data
+    assert not (tmp_path / "foo-1.0.0.crate.part").exists()
+
+    with pytest.raises(Exception, match="Checksum mismatch"):
+        r2r.fetch("https://example.com/foo", str(tmp_path / "bar.crate"), "0" * 64, "bar")
+    assert not (tmp_path / "bar.crate").exists()
+    assert not (tmp_path / "bar.crate.part").exists()
+
+def _make_crate(cratef, files):
+    with tarfile.open(cratef, "w:gz") as archive:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+def test_toml_from_crate(tmp_path):
+    cratef = tmp_path / "foo-1.0.0.crate"
+    files = {
+        "foo-1.0.0/Cargo.toml": b'[package]\nname = "foo"\nversion = "1.0.0"\n',
+        "foo-1.0.0/README.md": b"# foo",
+        "foo-1.0.0/src/lib.rs": b"pub fn foo() {}",
+        "foo-1.0.0/src/bin/tool.rs": b"fn main() {}",
+        "foo-1.0.0/vendor/big.c": b"int x;" * 1000,
+    }
+    _make_crate(cratef, files)
+
+    with r2r.toml_from_crate(str(cratef), "foo", "1.0.0") as toml:
+        root = os.path.dirname(toml)
+        assert open(toml, "rb").read() == files["foo-1.0.0/Cargo.toml"]
+        assert os.path.getsize(os.path.join(root, "src", "lib.rs")) == 0
+        assert not os.path.exists(os.path.join(root, "vendor"))
+        md = rust2rpm.Metadata.from_file(toml)
+        assert md.readme == "README.md"
+        assert {(t.name, t.kind) for t in md.targets} == {("foo", "lib"), ("tool", "bin")}
+
+    # Manifests left to cargo get the whole crate
+    files["foo-1.0.0/Cargo.toml"] = b'[package]\nname = "foo"\nversion.workspace = true\n'
+    _make_crate(cratef, files)
+    with r2r.toml_from_crate(str(cratef), "foo", "1.0.0") as toml:
+        assert os.path.isfile(os.path.join(os.path.dirname(toml), "vendor", "big.c"))
+
+def test_read_batch():
+    specs = r2r.read_batch(io.StringIO("serde\n\n# comment\nrand 0.7.3  # pinned\n./foo-1.0.crate\n"))
+    assert specs == [("serde", None), ("rand", "0.7.3"), ("./foo-1.0.crate", None)]
+    with pytest.raises(ValueError):
+        r2r.read_batch(io.StringIO("serde 1 2\n"))
+
+def test_batch_duplicates(tmp_path, monkeypatch, capsys):
+    (tmp_path / "batch").write_text("serde 1.0.0\nrand\nserde 1.0.1\n")
+    generated = []
+    def generate(args, crate, version, packager=None, conf=None):
+        generated.append((crate, version))
+        return f"rust-{crate}.spec", object()
+    monkeypatch.setattr(r2r, "generate", generate)
+    monkeypatch.setattr(r2r, "detect_packager", lambda: "Packager <packager@example.com>")
+    monkeypatch.chdir(tmp_path)
+
+    args = types.SimpleNamespace(batch=str(tmp_path / "batch"), target="fedora", jobs=4)
+    assert r2r.batch(args) == 0
+    assert sorted(generated) == [("rand", None), ("serde", "1.0.0")]
+    status = capsys.readouterr().err
+    assert "serde 1.0.1: SKIPPED (generating serde 1.0.0)" in status
+    assert "2 succeeded, 0 failed" in status
+    assert r2r.session().get_adapter("https://crates.io")._pool_maxsize == 4
+
+def test_recursive(tmp_path, monkeypatch, capsys):
+    crates = {
+        ("app", "0.1.0"): '[dependencies]\nlib = "1"\nother = "0.3"\n',
+        ("lib", "1.2.0"): '[dependencies]\nleaf = "0.1"\n[dev-dependencies]\napp = "0.1"\n',
+        ("leaf", "0.1.5"): '',
+    }
+    for (name, version), deps in crates.items():
+        toml = f'[package]\nname = "{name}"\nversion = "{version}"\n{deps}'
+        _make_crate(tmp_path / f"{name}-{version}.crate",
+                    {f"{name}-{version}/Cargo.toml": toml.encode(),
+                     f"{name}-{version}/src/lib.rs": b""})
+    versions = {
+        "lib": ["2.0.0", "1.2.0", "1.1.0", "1.3.0-beta.1"],
+        "leaf": ["0.2.0", "0.1.5"],
+        "app": ["0.1.0"],
+    }
+    monkeypatch.setattr(r2r, "crate_versions",
+                        lambda crate: [{"num": v, "yanked": False} for v in versions[crate]])
+    monkeypatch.setattr(r2r, "download",
+                        lambda crate, version: (str(tmp_path / f"{crate}-{version}.crate"), crate, version))
+    monkeypatch.setattr(r2r, "detect_packager", lambda: "Packager <packager@example.com>")
+    (tmp_path / "registry" / "other-0.3.1").mkdir(parents=True)
+    # as named by %cargo_install
+    (tmp_path / "registry" / "leaf-0.0.9~beta.1").mkdir()
+    monkeypatch.chdir(tmp_path)
+
+    args = types.SimpleNamespace(crate="app", version="0.1.0", target="fedora", patch=False,
+                                 store_crate=False, stdout=False, no_auto_changelog_entry=False, template=None,
+                                 registry=str(tmp_path / "registry"), with_dev=True, jobs=2, force=False,
+                                 minimal_buildroot=False, features=None,
+                                 check_provides=None)
+    assert r2r.recursive(args) == 0
+    assert sorted(p.name for p in tmp_path.glob("*.spec")) == ["rust-app.spec", "rust-leaf.spec",
+                                                              "rust-lib.spec"]
+    assert "Version:        1.2.0" in (tmp_path / "rust-lib.spec").read_text()
+
+    # Nothing changed, nothing is rewritten; edited specs are regenerated
+    (tmp_path / "rust-leaf.spec").write_text("edited")
+    capsys.readouterr()
+    assert r2r.recursive(args) == 0
+    status = capsys.readouterr().err
+    assert "app 0.1.0: UNCHANGED (rust-app.spec)" in status
+    assert "lib 1.2.0: UNCHANGED (rust-lib.spec)" in status
+    assert "leaf 0.1.5: OK (rust-leaf.spec)" in status
+    assert "Version:        0.1.5" in (tmp_path / "rust-leaf.spec").read_text()
+
+    # So is everything after changes to rust2rpm itself
+    monkeypatch.setattr(r2r, "sources_digest", lambda: "changed")
+    assert r2r.recursive(args) == 0
+    assert "UNCHANGED" not in capsys.readouterr().err
+
+    args.force = True
+    assert r2r.recursive(args) == 0
+    assert "UNCHANGED" not in capsys.readouterr().err
+
+    # An unresolvable dependency fails on its own, its parent is fine
+    versions["leaf"] = ["0.2.0"]
+    assert r2r.recursive(args) == 1
+    status = capsys.readouterr().err
+    assert "lib 1.2.0: OK (rust-lib.spec)" in status
+    assert "leaf: FAILED (No version of leaf matches '^0.1')" in status
+    assert "2 crates processed, 1 failed" in status
+
+def test_crate_index(tmp_path):
+    entries = [{"name": "serde", "vers": v, "cksum": f"{i:064x}", "yanked": v == "1.0.2", "deps": []}
+               for i, v in enumerate(["1.0.0", "1.0.10", "1.0.2", "0.9.0"])]
+    (tmp_path / "se" / "rd").mkdir(parents=True)
+    (tmp_path / "se" / "rd" / "serde").write_text("\n".join(map(json.dumps, entries)) + "\n")
+    (tmp_path / "config.json").write_text('{"dl": "https://mirror.example.com/{lowerprefix}/{crate}/{version}"}')
+
+    assert rust2rpm.index.index_path("a") == "1/a"
+    assert rust2rpm.index.index_path("Syn") == "3/s/syn"
+    index = rust2rpm.index.CrateIndex(str(tmp_path))
+    versions = index.versions("serde")
+    assert [v["num"] for v in versions] == ["1.0.10", "1.0.2", "1.0.0", "0.9.0"]
+    assert versions[1]["yanked"]
+    assert index.checksum("serde", "1.0.10") == f"{1:064x}"
+    assert index.download_url("serde", "1.0.10") == "https://mirror.example.com/se/rd/serde/1.0.10"
+    with pytest.raises(LookupError):
+        index.versions("missing")
+
+def test_response_cache(tmp_path):
+    body = json.dumps({"versions": [{"num": "1.0.0"}]}).encode()
+    requests_seen = []
+    def get(url, headers={}):
+        requests_seen.append(headers)
+        if requests_seen[-1].get("If-None-Match") == '"v1"':
+            if len(requests_seen) > 2:
+                raise r2r.requests.ConnectionError("offline")
+            return FakeResponse(b"", 304)
+        return FakeResponse(body, headers={"ETag": '"v1"'})
+    session = types.SimpleNamespace(get=get)
+
+    cache = rust2rpm.cache.ResponseCache(str(tmp_path), ttl=3600)
+    url = "https://crates.io/api/v1/crates/foo/versions"
+    assert cache.get_json(session, url) == json.loads(body)
+    assert cache.get_json(session, url) == json.loads(body)
+    assert requests_seen == [{}]
+
+    cache.ttl = 0
+    assert cache.get_json(session, url) == json.loads(body)
+    assert requests_seen[-1] == {"If-None-Match": '"v1"'}
+    # offline: stale entry is used
+    assert cache.get_json(session, url) == json.loads(body)
+    assert len(requests_seen) == 3
+
+def test_crate_cache(tmp_path, monkeypatch):
+    clock = iter(range(1000))
+    monkeypatch.setattr(rust2rpm.cache.time, "time", lambda: next(clock))
+    cache = rust2rpm.cache.CrateCache(str(tmp_path), max_size=250)
+    for name in ("a", "b", "c"):
+        path = tmp_path / f"{name}-1.0.0.crate"
+        path.write_bytes(name.encode() * 100)
+        assert cache.add(str(path), hashlib.sha256(path.read_bytes()).hexdigest()) == (
+            ["a-1.0.0.crate"] if name == "c" else [])
+    assert cache.lookup("a", "1.0.0") is None
+    assert cache.lookup("b", "1.0.0") == str(tmp_path / "b-1.0.0.crate")
+
+    # adopted from before the index existed
+    (tmp_path / "d-1.0.0.crate").write_bytes(b"d" * 10)
+    os.utime(tmp_path / "d-1.0.0.crate", (0, 0))
+    # with a resumable download and locks left behind
+    (tmp_path / "e-1.0.0.crate.part").write_bytes(b"e" * 40)
+    os.utime(tmp_path / "e-1.0.0.crate.part", (1, 1))
+    for name in ("a", "c", "e"):
+        (tmp_path / f"{name}-1.0.0.crate.lock").touch()
+    assert cache.stats() == {"crates": 3, "size": 210, "partial": 40, "max_size": 250,
+                             "unverified": 1}
+    # b was used more recently than c
+    assert cache.prune(max_size=150) == ["d-1.0.0.crate", "e-1.0.0.crate.part", "c-1.0.0.crate"]
+    assert sorted(p.name for p in tmp_path.glob("*.crate*")) == ["b-1.0.0.crate"]
+
+    # adopted crates are checked against the index
+    (tmp_path / "f-1.0.0.crate").write_bytes(b"f" * 10)
+    checksums = {"f-1.0.0.crate": hashlib.sha256(b"g" * 10).hexdigest()}
+    (tmp_path / "b-1.0.0.crate").write_bytes(b"x" * 100)
+    assert cache.verify(checksums.get) == ["b-1.0.0.crate", "f-1.0.0.crate"]
+    assert cache.stats()["crates"] == 0
+
+def test_provides_index(tmp_path, monkeypatch):
+    registry = tmp_path / "registry"
+    def install(name, version, features=""):
+        (registry / f"{name}-{version}" / "src").mkdir(parents=True)
+        (registry / f"{name}-{version}" / "src" / "lib.rs").touch()
+        (registry / f"{name}-{version}" / "Cargo.toml").write_text(
+            f'[package]\nname = "{name}"\nversion = "{version}"\n[features]\n{features}')
+    install("foo", "1.2.0", 'std = []\n')
+    install("bar", "0.3.1")
+    (tmp_path / "provides.txt").write_text("crate(baz) = 2.0.0~beta.1\ncrate(baz/alloc) = 2.0.0~beta.1\n"
+                                           "rust-baz-devel = 2.0.0\n")
+
+    index = rust2rpm.provides.ProvidesIndex(str(tmp_path / "provides.json"))
+    index.add_registry(str(registry))
+    index.add_list(str(tmp_path / "provides.txt"))
+    assert index.update() == 3
+    index.save()
+
+    index = rust2rpm.provides.ProvidesIndex(str(tmp_path / "provides.json"))
+    assert index.update() == 0
+    N = rust2rpm.Dependency._normalize_req
+    assert index.satisfied("foo", N("^1.1"), "std")
+    assert index.satisfied("foo", N("^1.1"), "default")
+    assert not index.satisfied("foo", N("^1.3"))
+    assert not index.satisfied("foo", N("^1.1"), "serde")
+    assert index.satisfied("baz", N("^2.0.0-beta.1"), "alloc")
+    assert not index.satisfied("qux", N("*"))
+
+    # Only the new directory is read
+    install("qux", "0.1.0")
+    assert index.update() == 1
+    assert index.satisfied("qux", N("*"))
+
+    md = _metadata([_dep("foo", "^1"), _dep("bar", "^0.4")], name="app", kind="bin")
+    monkeypatch.setattr(r2r, "provides_index", lambda registry: index)
+    args = types.SimpleNamespace(target="fedora", no_auto_changelog_entry=False, registry=None,
+                                 minimal_buildroot=False, features=None, check_provides="annotate")
+    kwargs = r2r.template_kwargs(args, "app", md, packager="P", conf={"fedora": {}})
+    assert kwargs["unsatisfied"] == ["(crate(bar/default) >= 0.4.0 with crate(bar/default) < 0.5.0)"]
+    args.check_provides = "fail"
+    with pytest.raises(ValueError):
+        r2r.template_kwargs(args, "app", md, packager="P", conf={"fedora": {}})
+
+def test_jinja_env(tmp_path):
+    r2r.jinja_env.cache_clear()
+    user_template = tmp_path / "custom.spec"
+    user_template.write_text("{{ to_list(text)|join(',') }}")
+
+    env = r2r.jinja_env(bytecode_dir=str(tmp_path / "bytecode"))
+    env.get_template("main.spec")
+    assert list((tmp_path / "bytecode").iterdir())
+    with pytest.raises(r2r.jinja2.TemplateNotFound):
+        env.get_template(str(user_template))
+
+    env = r2r.jinja_env(user_templates=True, bytecode_dir=str(tmp_path / "bytecode"))
+    assert env.get_template(str(user_template)).render(text="a\n b\n\n") == "a,b"
+    r2r.jinja_env.cache_clear()
+
+def test_feature_subpackages():
+    md = _metadata([_dep("bar", "^0.1", optional=True)],
+                   {"default": ["std"], "std": [], "Extra": ["bar"]})
+    subpackages = r2r.feature_subpackages(md, {"lib+std.requires": "pkgconfig(x)"},
+                                          provides=True, requires=True)
+    assert [s["pkg"] for s in subpackages] == ["   devel", "-n %{name}+default-devel",
+                                               "-n %{name}+bar-devel", "-n %{name}+Extra-devel",
+                                               "-n %{name}+std-devel"]
+    assert subpackages[1]["requires"] == ["crate(foo) = 1.0.0", "crate(foo/std) = 1.0.0"]
+    assert subpackages[3]["requires"] == [
+        "(crate(bar/default) >= 0.1.0 with crate(bar/default) < 0.2.0)", "crate(foo) = 1.0.0"]
+    assert subpackages[4]["provides"] == "crate(foo/std) = 1.0.0"
+    assert subpackages[4]["extra_requires"] == ["pkgconfig(x)"]
+
+def test_inspector_imports(tmp_path):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "lib.rs").touch()
+    (tmp_path / "Cargo.toml").write_text('[package]\nname = "foo"\nversion = "1.0.0"\n')
+    code = ("import sys; from rust2rpm import inspector; "
+            f"sys.argv = ['cargo-inspector', '--no-cache', '-n', '{tmp_path}/Cargo.toml']; "
+            "inspector.main(); print(' '.join(sys.modules))")
+    out = subprocess.check_output([sys.executable, "-c", code],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  universal_newlines=True)
+    name, modules = out.splitlines()
+    assert name == "foo"
+    heavy = {"semantic_version", "rustcfg", "pyparsing", "jinja2", "requests", "tqdm",
+             "subprocess", "concurrent.futures"}
+    assert heavy.isdisjoint(modules.split())
+
+def test_timings(tmp_path, monkeypatch, capsys):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "lib.rs").touch()
+    (tmp_path / "Cargo.toml").write_text('[package]\nname = "foo"\nversion = "1.0.0"\n')
+    log = tmp_path / "timings.jsonl"
+    monkeypatch.setenv("RUST2RPM_TIMINGS", str(log))
+    monkeypatch.setattr(sys, "argv", ["cargo-inspector", "--no-cache", "--profile",
+                                      str(tmp_path / "inspector-{pid}.prof"),
+                                      "-n", str(tmp_path / "Cargo.toml")])
+    try:
+        inspector.main()
+        with pytest.raises(KeyError), rust2rpm.timings.phase("broken"):
+            raise KeyError()
+    finally:
+        rust2rpm.timings.configure(None)
+
+    records = [json.loads(line) for line in log.read_text().splitlines()]
+    assert [r["phase"] for r in records] == ["read-manifest", "output", "main", "broken"]
+    assert all(r["program"] == "cargo-inspector" and r["wall"] >= 0 for r in records)
+    assert "error" not in records[0] and records[-1]["error"] == "KeyError"
+    assert len(list(tmp_path.glob("inspector-*.prof"))) == 1
+
+    # --timings always takes a value, it never swallows the manifest
+    monkeypatch.delenv("RUST2RPM_TIMINGS")
+    log.unlink()
+    capsys.readouterr()
+    manifest = (tmp_path / "Cargo.toml").read_text()
+    monkeypatch.setattr(sys, "argv", ["cargo-inspector", "--no-cache", "-n", "--timings", str(log),
+                                      str(tmp_path / "Cargo.toml")])
+    try:
+        inspector.main()
+    finally:
+        rust2rpm.timings.configure(None)
+    assert capsys.readouterr().out == "foo\n"
+    assert (tmp_path / "Cargo.toml").read_text() == manifest
+    assert [json.loads(line)["phase"] for line in log.read_text().splitlines()] == [
+        "read-manifest", "output", "main"]